@@ -9,7 +9,7 @@ README = open(os.path.join(HERE, 'README.rst')).read()
 CHANGES = open(os.path.join(HERE, 'CHANGES.txt')).read()
 
 REQUIREMENTS = [
-    'pyramid>=1.4',
+    'pyramid>=1.5',
     'pyramid_duh',
     'requests',
     'PyYAML',
@@ -47,6 +47,7 @@ DATA = {
         'console_scripts': [
             'steward = steward.client:run_client',
             'steward-gen-password = steward.scripts:gen_password',
+            'steward-bench = steward.bench:run_bench',
         ],
         'paste.app_factory': [
             'main = steward:main',
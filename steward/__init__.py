@@ -1,18 +1,129 @@
 """ A server orchestration framework written as a Pyramid app """
 import datetime
+import threading
+import time
 
 import json
+from collections import Iterator
+from multiprocessing.pool import ThreadPool, TimeoutError
 from pyramid.config import Configurator
-from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPBadRequest, HTTPGatewayTimeout
+from pyramid.path import DottedNameResolver
 from pyramid.renderers import JSON, render
 from pyramid.request import Request
 from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
 from urllib import urlencode
 
+from steward.util import to_timestamp
 
-json_renderer = JSON()  # pylint: disable=C0103
+
+NDJSON = 'application/x-ndjson'
+_POOL_LOCK = threading.Lock()
+_WORKER = threading.local()
+
+
+def _load_json_backend(name='auto'):
+    """
+    Find the json module to use for rendering
+
+    Parameters
+    ----------
+    name : str, optional
+        The name of a module with a ``json.dumps``-compatible ``dumps``
+        function (it must support the ``default`` argument). If 'auto', use
+        ``simplejson`` if it is installed and the stdlib ``json`` otherwise.
+
+    """
+    if name == 'auto':
+        try:
+            import simplejson
+            return simplejson
+        except ImportError:
+            return json
+    return DottedNameResolver(__package__).resolve(name)
+
+
+class StewardJSON(JSON):
+
+    """
+    JSON renderer with support for in-process subrequests and streaming
+
+    When a subrequest is made in-process (see :func:`_subreq`), the value
+    returned by the view is stored in the request environ as
+    ``steward.subreq.result`` instead of being encoded.
+
+    If the view returns an iterator (such as a generator), it is streamed to
+    the client as a JSON list, ``chunk_size`` items at a time, without
+    building the whole body in memory. If the client accepts
+    ``application/x-ndjson``, the iterator is instead streamed as newline
+    delimited JSON, one item per chunk, so the client can process each item
+    as soon as it is produced.
+
+    """
+    chunk_size = 100
+
+    def _iter_list(self, iterator, default):
+        """ Encode an iterator as chunks of a JSON list """
+        yield b'['
+        chunk = []
+        first = True
+        for item in iterator:
+            chunk.append(self.serializer(item, default=default, **self.kw))
+            if len(chunk) >= self.chunk_size:
+                yield (b'' if first else b',') + b','.join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield (b'' if first else b',') + b','.join(chunk)
+        yield b']'
+
+    def _iter_lines(self, iterator, default):
+        """ Encode an iterator as newline delimited JSON """
+        for item in iterator:
+            yield self.serializer(item, default=default, **self.kw) + b'\n'
+
+    def __call__(self, info):
+        render = super(StewardJSON, self).__call__(info)
+
+        def _render(value, system):
+            """ Render the value, or stash it for an in-process subrequest """
+            request = system.get('request')
+            if request is not None:
+                if request.environ.get('steward.subreq.inprocess'):
+                    request.environ['steward.subreq.result'] = value
+                    return ''
+                if isinstance(value, Iterator):
+                    default = self._make_default(request)
+                    response = request.response
+                    if NDJSON in request.headers.get('Accept', ''):
+                        response.content_type = NDJSON
+                        return self._iter_lines(value, default)
+                    if response.content_type == \
+                            response.default_content_type:
+                        response.content_type = 'application/json'
+                    return self._iter_list(value, default)
+            return render(value, system)
+        return _render
+
+
+json_renderer = StewardJSON()  # pylint: disable=C0103
 json_renderer.add_adapter(datetime.datetime,
-                          lambda obj, _: float(obj.strftime('%s.%f')))
+                          lambda obj, _: to_timestamp(obj))
+
+
+class InProcessRequest(Request):
+
+    """
+    Subrequest that receives its parameters as python objects
+
+    The parameters are exposed as the ``json_body`` so that
+    ``request.param()`` reads them without any decoding.
+
+    """
+    @property
+    def json_body(self):
+        return self.environ['steward.subreq.params']
 
 
 def _argify_kwargs(request, kwargs):
@@ -23,10 +134,66 @@ def _argify_kwargs(request, kwargs):
     return kwargs
 
 
+class SubrequestMemo(object):
+
+    """
+    Per-request cache of the results of cacheable subrequests
+
+    Attributes
+    ----------
+    hits : int
+        Number of subrequests answered from the cache
+    misses : int
+        Number of cacheable subrequests that had to run the view
+
+    """
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(route_name, kwargs):
+        """ Build a cache key from a route name and parameters """
+        try:
+            return route_name, frozenset(kwargs.iteritems())
+        except TypeError:
+            return route_name, json.dumps(kwargs, sort_keys=True, default=repr)
+
+
+def _subreq_memo(request):
+    """ Get the subrequest memo, which is shared with all subrequests """
+    memo = request.environ.get('steward.subreq.memo')
+    if memo is None:
+        memo = request.environ['steward.subreq.memo'] = SubrequestMemo()
+    return memo
+
+
+def _add_cacheable_route(config, route_name):
+    """
+    Config directive that marks a route as idempotent
+
+    Repeated calls to ``request.subreq`` for that route with the same
+    arguments during a single request will return the memoized result instead
+    of re-running the view. Callers should treat the result as read-only.
+
+    """
+    config.registry.cacheable_routes.add(route_name)
+
+
 def _subreq(request, route_name, **kwargs):
     """
     Convenience method for doing internal subrequests
 
+    If the route was marked with ``config.add_cacheable_route``, results are
+    memoized for the duration of the request (see :class:`SubrequestMemo`).
+
+    If ``steward.subreq.inprocess`` is true, the parameters are passed to the
+    view as python objects and the unrendered return value of the view is
+    returned, skipping the JSON encode/decode steps. Permissions are checked
+    the same as with a normal subrequest. Views must use ``request.param()``
+    or ``request.json_body`` to read their parameters in this mode.
+
     Parameters
     ----------
     route_name : str
@@ -35,18 +202,143 @@ def _subreq(request, route_name, **kwargs):
         The parameters to pass through in the request
 
     """
-    req = Request.blank(request.route_path(route_name))
+    if route_name not in request.registry.cacheable_routes:
+        return _invoke_subreq(request, route_name, kwargs)
+    memo = _subreq_memo(request)
+    key = memo.key(route_name, kwargs)
+    if key in memo.results:
+        memo.hits += 1
+        return memo.results[key]
+    memo.misses += 1
+    result = memo.results[key] = _invoke_subreq(request, route_name, kwargs)
+    return result
+
+
+def _invoke_subreq(request, route_name, kwargs):
+    """ Run a subrequest (see :func:`_subreq`) """
+    metrics = request.registry.metrics
+    if metrics is None:
+        return _make_subreq(request, route_name, kwargs)
+    start = time.time()
+    try:
+        return _make_subreq(request, route_name, kwargs)
+    finally:
+        metrics.observe_subrequest(route_name, time.time() - start)
+
+
+def _make_subreq(request, route_name, kwargs):
+    """ Build and invoke a subrequest """
+    inprocess = request.registry.subreq_inprocess
+    factory = InProcessRequest if inprocess else Request
+    req = factory.blank(request.route_path(route_name))
     req.method = 'POST'
     for name in request.registry.subrequest_methods:
         setattr(req, name, getattr(request, name))
-    kwargs = _argify_kwargs(request, kwargs)
-    req.body = urlencode(kwargs)
+    if inprocess:
+        for key, value in kwargs.items():
+            if isinstance(value, datetime.datetime):
+                kwargs[key] = to_timestamp(value)
+        req.content_type = 'application/json'
+        req.environ['steward.subreq.inprocess'] = True
+        req.environ['steward.subreq.params'] = kwargs
+    else:
+        kwargs = _argify_kwargs(request, kwargs)
+        req.body = urlencode(kwargs)
     req.cookies = request.cookies
+    # Share the authentication results with the subrequest
+    req.environ['steward.groups'] = request.environ.setdefault(
+        'steward.groups', {})
+    if request.registry.cacheable_routes:
+        req.environ['steward.subreq.memo'] = _subreq_memo(request)
     response = request.invoke_subrequest(req)
+    if 'steward.subreq.result' in req.environ:
+        return req.environ['steward.subreq.result']
     if response.body:
         return json.loads(response.body)
 
 
+def _subreq_pool(registry):
+    """ Get the thread pool used by ``request.subreq_many`` """
+    if registry.subreq_pool is None:
+        with _POOL_LOCK:
+            if registry.subreq_pool is None:
+                registry.subreq_pool = ThreadPool(registry.subreq_threads)
+    return registry.subreq_pool
+
+
+def _subreq_worker(request, route_name, kwargs):
+    """ Run a subrequest on a thread in the subrequest pool """
+    _WORKER.active = True
+    try:
+        return _subreq(request, route_name, **kwargs)
+    finally:
+        _WORKER.active = False
+
+
+def _subreq_many(request, calls, timeout=None):
+    """
+    Run several independent internal subrequests in parallel
+
+    The subrequests are run on a bounded thread pool (the size is set by
+    ``steward.subreq.threads``). If this is called from inside one of those
+    subrequests, the calls are run sequentially instead so that the pool
+    cannot deadlock.
+
+    Parameters
+    ----------
+    calls : list
+        List of ``(route_name, kwargs)`` tuples
+    timeout : float, optional
+        Maximum number of seconds to wait for all of the calls to finish
+
+    Returns
+    -------
+    results : list
+        The result of each call, in order. If a call raised an exception, the
+        exception is returned in its place. If a call did not finish within
+        the timeout, a :class:`~pyramid.httpexceptions.HTTPGatewayTimeout` is
+        returned in its place.
+
+    """
+    calls = [(route_name, dict(kwargs or {})) for route_name, kwargs in calls]
+    # Evaluate anything that is lazily computed on the parent request before
+    # the workers read it concurrently
+    for name in request.registry.subrequest_methods:
+        getattr(request, name)
+    request.cookies  # pylint: disable=W0104
+    request.environ.setdefault('steward.groups', {})
+    if request.registry.cacheable_routes:
+        _subreq_memo(request)
+
+    if getattr(_WORKER, 'active', False):
+        results = []
+        for route_name, kwargs in calls:
+            try:
+                results.append(_subreq(request, route_name, **kwargs))
+            except Exception as e:  # pylint: disable=W0703
+                results.append(e)
+        return results
+
+    pool = _subreq_pool(request.registry)
+    pending = [pool.apply_async(_subreq_worker, (request, route_name, kwargs))
+               for route_name, kwargs in calls]
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for (route_name, _), result in zip(calls, pending):
+        try:
+            if deadline is None:
+                # A timeout is required for the wait to be interruptible
+                results.append(result.get(2 ** 31))
+            else:
+                results.append(result.get(max(0, deadline - time.time())))
+        except TimeoutError:
+            results.append(HTTPGatewayTimeout(
+                "Subrequest '%s' timed out" % route_name))
+        except Exception as e:  # pylint: disable=W0703
+            results.append(e)
+    return results
+
+
 def _safe_subreq(request, route_name, **kwargs):
     """
     Do an internal subrequest. If the route name does not exist, return None.
@@ -60,15 +352,38 @@ def _safe_subreq(request, route_name, **kwargs):
 
 def includeme(config):
     """ Configure the app """
+    settings = config.get_settings()
     config.registry.subrequest_methods = []
+    config.registry.cacheable_routes = set()
+    config.registry.subreq_threads = int(settings.get('steward.subreq.threads',
+                                                      10))
+    config.registry.subreq_pool = None
+    config.add_directive('add_cacheable_route', _add_cacheable_route)
+    config.registry.subreq_inprocess = asbool(
+        settings.get('steward.subreq.inprocess', False))
     config.include('pyramid_duh')
     config.include('pyramid_duh.auth')
+    config.include('steward.metrics')
     config.include('steward.auth')
+    config.include('steward.cache')
     config.include('steward.base')
+    config.include('steward.compress')
+    config.include('steward.events')
+    config.include('steward.profile')
     config.add_request_method(_subreq, name='subreq')
     config.add_request_method(_safe_subreq, name='safe_subreq')
+    config.add_request_method(_subreq_many, name='subreq_many')
+    config.add_request_method(_subreq_memo, name='subreq_memo', reify=True)
+    json_renderer.serializer = _load_json_backend(
+        settings.get('steward.json.backend', 'auto')).dumps
+    json_renderer.chunk_size = int(settings.get('steward.json.chunk_size',
+                                                100))
     config.add_renderer('json', json_renderer)
 
+    config.add_route('batch', '/batch')
+    config.add_view('steward.views.do_batch', route_name='batch',
+                    renderer='json')
+
     config.add_view('steward.views.bad_request', context=HTTPBadRequest,
                     renderer='json', permission=NO_PERMISSION_REQUIRED)
     config.add_view('steward.views.server_error', context=Exception,
@@ -1,12 +1,25 @@
 """ Authentication and authorization tools for Steward """
+import os
+
+import hashlib
+import hmac
+import logging
+import threading
+import time
 from passlib.hash import sha256_crypt  # pylint: disable=E0611
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.path import DottedNameResolver
 from pyramid.security import (Allow, Deny, Everyone, Authenticated,
                               ALL_PERMISSIONS, unauthenticated_userid,
-                              NO_PERMISSION_REQUIRED)
+                              NO_PERMISSION_REQUIRED, ACLAllowed, ACLDenied)
 from pyramid.settings import aslist, asbool
+from pyramid.util import is_nonstr_iter
+
+from steward.util import LRUCache
+
+
+LOG = logging.getLogger(__name__)
 
 
 def asint(setting):
@@ -34,7 +47,15 @@ class IAuthDB(object):
     """
     Interface for accessing a list of user credentials and user security groups
 
+    Attributes
+    ----------
+    generation : int
+        Implementations should increment this whenever the user data changes.
+        Caches use it to discard stale entries.
+
     """
+    generation = 0
+
     def __init__(self, config):
         self.config = config
 
@@ -87,6 +108,128 @@ class DummyAuthDB(IAuthDB):
         return []
 
 
+class CachedAuthDB(IAuthDB):
+
+    """
+    Auth object that caches successful logins of another auth object
+
+    Verifying a salted password hash is intentionally slow, so this keeps a
+    bounded LRU cache of credentials that have already been verified. Only a
+    keyed HMAC of the credentials is stored, never the password itself. The
+    cache is cleared whenever the ``generation`` of the wrapped auth db
+    changes. Failed logins are never cached.
+
+    Parameters
+    ----------
+    config : :class:`pyramid.config.Configurator`
+    auth_db : :class:`~.IAuthDB`
+        The auth db to wrap
+    max_size : int, optional
+        Maximum number of cached credentials (default 1000)
+    ttl : float, optional
+        Number of seconds to cache a login for (default 300)
+
+    Notes
+    -----
+    Enable the cache with these settings::
+
+        steward.auth.login_cache = true
+        steward.auth.login_cache.size = 1000
+        steward.auth.login_cache.ttl = 300
+
+    """
+    def __init__(self, config, auth_db, max_size=1000, ttl=300):
+        super(CachedAuthDB, self).__init__(config)
+        self.auth_db = auth_db
+        self.cache = LRUCache(max_size, ttl)
+        self._key = os.urandom(32)
+        self._generation = auth_db.generation
+
+    @property
+    def generation(self):
+        """ The generation of the wrapped auth db """
+        return self.auth_db.generation
+
+    def _digest(self, userid, password):
+        """ Compute the cache key for a set of credentials """
+        if isinstance(userid, unicode):
+            userid = userid.encode('utf-8')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(self._key, userid + '\0' + password,
+                        hashlib.sha256).digest()
+
+    def authenticate(self, request, userid, password):
+        if self.auth_db.generation != self._generation:
+            self.cache.clear()
+            self._generation = self.auth_db.generation
+        digest = self._digest(userid, password)
+        if self.cache.get(digest) == self._generation:
+            return True
+        generation = self._generation
+        valid = self.auth_db.authenticate(request, userid, password)
+        if valid:
+            self.cache.set(digest, generation)
+        return valid
+
+    def groups(self, userid, request):
+        return self.auth_db.groups(userid, request)
+
+    def stats(self):
+        """ Get the cache size and hit rate """
+        return self.cache.stats()
+
+    def __getattr__(self, name):
+        # Expose the rest of the wrapped auth db (e.g. YamlAuthDB.reload)
+        if name == 'auth_db':
+            raise AttributeError(name)
+        return getattr(self.auth_db, name)
+
+
+class TimedAuthDB(IAuthDB):
+
+    """
+    Auth object that records the time spent in another auth object
+
+    Parameters
+    ----------
+    config : :class:`pyramid.config.Configurator`
+    auth_db : :class:`~.IAuthDB`
+        The auth db to wrap
+    metrics : :class:`~steward.metrics.Metrics`
+
+    """
+    def __init__(self, config, auth_db, metrics):
+        super(TimedAuthDB, self).__init__(config)
+        self.auth_db = auth_db
+        self.metrics = metrics
+
+    @property
+    def generation(self):
+        """ The generation of the wrapped auth db """
+        return self.auth_db.generation
+
+    def authenticate(self, request, userid, password):
+        start = time.time()
+        try:
+            return self.auth_db.authenticate(request, userid, password)
+        finally:
+            self.metrics.observe_auth('authenticate', time.time() - start)
+
+    def groups(self, userid, request):
+        start = time.time()
+        try:
+            return self.auth_db.groups(userid, request)
+        finally:
+            self.metrics.observe_auth('groups', time.time() - start)
+
+    def __getattr__(self, name):
+        # Expose the rest of the wrapped auth db (e.g. YamlAuthDB.reload)
+        if name == 'auth_db':
+            raise AttributeError(name)
+        return getattr(self.auth_db, name)
+
+
 class SettingsAuthDB(IAuthDB):
 
     """
@@ -105,16 +248,28 @@ class SettingsAuthDB(IAuthDB):
         steward.auth.<username>.groups = <list of groups>
 
     """
+    def __init__(self, config):
+        super(SettingsAuthDB, self).__init__(config)
+        self.passwords = {}
+        self.group_index = {}
+        prefix = 'steward.auth.'
+        for key, value in config.get_settings().iteritems():
+            if not key.startswith(prefix):
+                continue
+            if key.endswith('.pass'):
+                self.passwords[key[len(prefix):-len('.pass')]] = value
+            elif key.endswith('.groups'):
+                userid = key[len(prefix):-len('.groups')]
+                self.group_index[userid] = frozenset(aslist(value))
+
     def authenticate(self, request, userid, password):
-        key = 'steward.auth.{0}.pass'.format(userid)
-        stored_pw = self.config.get_settings().get(key)
+        stored_pw = self.passwords.get(userid)
         if stored_pw is None:
             return False
         return sha256_crypt.verify(password, stored_pw)
 
     def groups(self, userid, request):
-        key = 'steward.auth.{0}.groups'.format(userid)
-        return aslist(request.registry.settings.get(key, []))
+        return self.group_index.get(userid, frozenset())
 
 
 class YamlAuthDB(IAuthDB):
@@ -141,15 +296,101 @@ class YamlAuthDB(IAuthDB):
     You may either put the path to the yaml file in the field
     ``steward.auth.db.file`` or as the value of ``steward.auth.db`` directly
 
+    If ``steward.auth.db.reload_interval`` is set, a background thread will
+    check the modification time and size of the file every that many seconds
+    and reload it if it has changed. Requests are never blocked by a reload;
+    they keep using the old data until the new data is swapped in.
+
     """
     def __init__(self, config):
         super(YamlAuthDB, self).__init__(config)
-        import yaml
         settings = config.get_settings()
-        filename = settings.get('steward.auth.db.file',
-                                settings['steward.auth.db'])
-        with open(filename, 'r') as infile:
-            self.data = yaml.safe_load(infile)
+        self.filename = settings.get('steward.auth.db.file',
+                                     settings['steward.auth.db'])
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_reload = None
+        self.last_reload_duration = None
+        self._stat = self._file_stat()
+        self._snapshot = self._load()
+        interval = settings.get('steward.auth.db.reload_interval')
+        if interval:
+            watcher = threading.Thread(target=self._watch,
+                                       args=(float(interval),))
+            watcher.daemon = True
+            watcher.start()
+
+    @property
+    def data(self):
+        """ The raw user data from the yaml file """
+        return self._snapshot[0]
+
+    @property
+    def group_index(self):
+        """ Mapping of userid to a frozenset of groups """
+        return self._snapshot[1]
+
+    def _file_stat(self):
+        """ Get the (mtime, size) of the yaml file """
+        stat = os.stat(self.filename)
+        return stat.st_mtime, stat.st_size
+
+    def _load(self):
+        """ Parse the yaml file and build the user index """
+        import yaml
+        with open(self.filename, 'r') as infile:
+            data = yaml.safe_load(infile)
+        group_index = dict((user, frozenset(groups or ())) for
+                           user, groups in data['groups'].iteritems())
+        return data, group_index
+
+    def _watch(self, interval):
+        """ Reload the yaml file whenever it changes (runs forever) """
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception:  # pylint: disable=W0703
+                self.reload_errors += 1
+                LOG.exception("Error reloading %s", self.filename)
+
+    def reload(self, force=False):
+        """
+        Reload the yaml file if it has changed
+
+        Parameters
+        ----------
+        force : bool, optional
+            Reload even if the file appears unchanged (default False)
+
+        Returns
+        -------
+        reloaded : bool
+
+        """
+        file_stat = self._file_stat()
+        if not force and file_stat == self._stat:
+            return False
+        start = time.time()
+        snapshot = self._load()
+        self._stat = file_stat
+        self._snapshot = snapshot
+        self.generation += 1
+        self.reloads += 1
+        self.last_reload = time.time()
+        self.last_reload_duration = self.last_reload - start
+        LOG.info("Reloaded %s in %.3fs", self.filename,
+                 self.last_reload_duration)
+        return True
+
+    def reload_stats(self):
+        """ Get the number of reloads and the time the last one took """
+        return {
+            'reloads': self.reloads,
+            'errors': self.reload_errors,
+            'last_reload': self.last_reload,
+            'last_duration': self.last_reload_duration,
+        }
 
     def authenticate(self, request, userid, password):
         stored_pw = self.data['users'].get(userid)
@@ -158,7 +399,140 @@ class YamlAuthDB(IAuthDB):
         return sha256_crypt.verify(password, stored_pw)
 
     def groups(self, user, request):
-        return self.data['groups'].get(user)
+        return self.group_index.get(user)
+
+
+class GroupsCallback(object):
+
+    """
+    Auth policy callback that caches the results of ``auth_db.groups``
+
+    The principals are always cached in the request environ, which is shared
+    with any subrequests (see :meth:`~steward._subreq`). This means that a
+    request that runs many subrequests, such as ``/batch``, only looks up the
+    user's groups once.
+
+    Optionally, the principals may also be cached for the whole process. This
+    is most useful for custom auth dbs that look up groups from a slow backend.
+    The process cache is cleared whenever the ``generation`` of the auth db
+    changes, or by calling :meth:`invalidate`.
+
+    Parameters
+    ----------
+    auth_db : :class:`~.IAuthDB`
+    cache : :class:`~steward.util.LRUCache`, optional
+        If provided, use this to cache principals for the whole process
+
+    Notes
+    -----
+    Enable the process cache with these settings::
+
+        steward.auth.groups_cache = true
+        steward.auth.groups_cache.size = 1000
+        steward.auth.groups_cache.ttl = 60
+
+    """
+    _missing = object()
+
+    def __init__(self, auth_db, cache=None):
+        self.auth_db = auth_db
+        self.cache = cache
+        self._generation = auth_db.generation
+
+    def _lookup(self, userid, request):
+        """ Look up the groups using the process cache """
+        if self.cache is None:
+            return self.auth_db.groups(userid, request)
+        if self.auth_db.generation != self._generation:
+            self.cache.clear()
+            self._generation = self.auth_db.generation
+        principals = self.cache.get(userid, self._missing)
+        if principals is self._missing:
+            principals = self.auth_db.groups(userid, request)
+            self.cache.set(userid, principals)
+        return principals
+
+    def __call__(self, userid, request):
+        cache = request.environ.setdefault('steward.groups', {})
+        if userid not in cache:
+            cache[userid] = self._lookup(userid, request)
+        return cache[userid]
+
+    def invalidate(self, userid=None):
+        """
+        Remove cached principals from the process cache
+
+        Parameters
+        ----------
+        userid : str, optional
+            If provided, only remove this user. Otherwise remove all users.
+
+        """
+        if self.cache is None:
+            return
+        if userid is None:
+            self.cache.clear()
+        else:
+            self.cache.delete(userid)
+
+
+class CompiledACLAuthorizationPolicy(ACLAuthorizationPolicy):
+
+    """
+    ACL authorization policy that precompiles the :class:`~.Root` ACL
+
+    The stock policy walks the whole ACL on every permission check. This
+    policy compiles the ACL into a list of ``(action, principals)`` runs
+    for each permission the first time that permission is checked, so a check
+    is a set intersection per run (usually just one or two). The decisions are
+    identical to :class:`~pyramid.authorization.ACLAuthorizationPolicy`.
+
+    Contexts other than :class:`~.Root` (or that override its ``__acl__``) are
+    passed through to the stock policy. If ``Root.__acl__`` changes size the
+    compiled runs are discarded and rebuilt.
+
+    """
+    def __init__(self, acl=None):
+        super(CompiledACLAuthorizationPolicy, self).__init__()
+        self.acl = Root.__acl__ if acl is None else acl
+        self._compiled = {}
+        self._acl_size = len(self.acl)
+
+    def _compile(self, permission):
+        """ Compile the ACL runs for a single permission """
+        runs = []
+        for index, ace in enumerate(self.acl):
+            action, principal, permissions = ace
+            if not is_nonstr_iter(permissions):
+                permissions = [permissions]
+            if permission not in permissions:
+                continue
+            if not runs or runs[-1][0] != action:
+                runs.append((action, {}))
+            runs[-1][1].setdefault(principal, (index, ace))
+        return [(action, aces, frozenset(aces)) for action, aces in runs]
+
+    def permits(self, context, principals, permission):
+        if getattr(context, '__acl__', None) is not self.acl:
+            return super(CompiledACLAuthorizationPolicy, self).permits(
+                context, principals, permission)
+        if len(self.acl) != self._acl_size:
+            self._compiled = {}
+            self._acl_size = len(self.acl)
+        runs = self._compiled.get(permission)
+        if runs is None:
+            runs = self._compiled[permission] = self._compile(permission)
+        for action, aces, allowed in runs:
+            matches = allowed.intersection(principals)
+            if matches:
+                ace = min(aces[principal] for principal in matches)[1]
+                if action == Allow:
+                    return ACLAllowed(ace, self.acl, permission, principals,
+                                      context)
+                return ACLDenied(ace, self.acl, permission, principals,
+                                 context)
+        return ACLDenied('<default deny>', self.acl, permission, principals,
+                         context)
 
 
 def add_acl_from_settings(config):
@@ -181,6 +555,7 @@ def add_acl_from_settings(config):
 
     """
     settings = config.get_settings()
+    entries = []
     for key, value in settings.iteritems():
         if not key.startswith('steward.perm.'):
             continue
@@ -190,7 +565,8 @@ def add_acl_from_settings(config):
                 principle = Authenticated
             elif principle.lower() == 'everyone':
                 principle = Everyone
-            Root.__acl__.insert(0, (Allow, principle, permission))
+            entries.append((Allow, principle, permission))
+    Root.__acl__[0:0] = entries
 
 
 def includeme(config):
@@ -217,14 +593,27 @@ def includeme(config):
     elif auth_db_source.endswith('.yaml'):
         auth_db_source = 'steward.auth.YamlAuthDB'
     auth_db = name_resolver.resolve(auth_db_source)(config)
+    if config.registry.metrics is not None:
+        auth_db = TimedAuthDB(config, auth_db, config.registry.metrics)
+    if asbool(settings.get('steward.auth.login_cache')):
+        auth_db = CachedAuthDB(
+            config, auth_db,
+            max_size=int(settings.get('steward.auth.login_cache.size', 1000)),
+            ttl=float(settings.get('steward.auth.login_cache.ttl', 300)))
 
     config.registry.auth_db = auth_db
+    groups_cache = None
+    if asbool(settings.get('steward.auth.groups_cache')):
+        groups_cache = LRUCache(
+            int(settings.get('steward.auth.groups_cache.size', 1000)),
+            float(settings.get('steward.auth.groups_cache.ttl', 60)))
+    config.registry.groups_callback = GroupsCallback(auth_db, groups_cache)
 
     config.set_authentication_policy(config.registry.authentication_policy)
-    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.set_authorization_policy(CompiledACLAuthorizationPolicy())
     auth_policy = AuthTktAuthenticationPolicy(
         settings['steward.cookie.secret'],
-        callback=auth_db.groups,
+        callback=config.registry.groups_callback,
         cookie_name=settings.get('steward.cookie.name', 'auth_tkt'),
         secure=asbool(settings.get('steward.cookie.secure')),
         timeout=asint(settings.get('steward.cookie.timeout')),
@@ -1,17 +1,44 @@
 """ Miscellaneous endpoints for Steward """
-import pkg_resources
+import hashlib
+import json
+import logging
 from pyramid.settings import aslist
 from pyramid.view import view_config
 
+from steward.util import distribution_version
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _find_versions(settings):
+    """ Get the versions of steward and all included extensions """
+    versions = {}
+    for name in aslist(settings.get('pyramid.includes', '')):
+        name = name.split('.')[0]
+        if name not in versions:
+            versions[name] = distribution_version(name)
+            if versions[name] is None:
+                LOG.warning("Could not find the version of '%s'", name)
+    return versions
+
 
 @view_config(route_name='version', renderer='json')
 def version(request):
-    """ Get the current version of steward and all extensions """
-    retval = {}
-    for name in aslist(request.registry.settings['pyramid.includes']):
-        name = name.split('.')[0]
-        retval[name] = pkg_resources.get_distribution(name).version
-    return retval
+    """
+    Get the current version of steward and all extensions
+
+    The versions are looked up once at startup. The response has an ETag, and
+    requests with a matching ``If-None-Match`` get a 304.
+
+    """
+    registry = request.registry
+    response = request.response
+    response.etag = registry.versions_etag
+    if registry.versions_etag in request.if_none_match:
+        response.status_int = 304
+        return response
+    return registry.versions
 
 
 def do_version(client):
@@ -28,5 +55,9 @@ def include_client(client):
 
 def includeme(config):
     """ Configure the app """
+    versions = _find_versions(config.get_settings())
+    config.registry.versions = versions
+    config.registry.versions_etag = hashlib.md5(
+        json.dumps(versions, sort_keys=True)).hexdigest()
     config.add_route('version', '/version')
     config.scan()
@@ -0,0 +1,285 @@
+"""
+In-process benchmarks for the core request paths
+
+The WSGI app is built with :func:`steward.main` and requests are sent to it
+directly, so there is no network or server overhead in the measurements.
+
+"""
+import os
+
+import json
+import shutil
+import tempfile
+import time
+import yaml
+from passlib.hash import sha256_crypt  # pylint: disable=E0611
+from pyramid.request import Request
+from pyramid.security import authenticated_userid
+
+from steward import main
+from steward.util import percentile
+
+
+USERID = 'bench'
+PASSWORD = 'bench'
+
+BENCH_SETTINGS = {
+    'pyramid.includes': 'steward\nsteward.bench',
+    'steward.auth.enable': 'true',
+    'steward.cookie.secret': 'bench',
+}
+
+
+def do_nested(request):
+    """
+    Make a chain of nested subrequests
+
+    Parameters
+    ----------
+    depth : int
+        The number of subrequests to make below this one
+
+    """
+    depth = request.param('depth', 0, type=int)
+    if depth > 0:
+        return request.subreq('bench_nested', depth=depth - 1)
+    return authenticated_userid(request)
+
+
+def includeme(config):
+    """ Add the endpoints used by the benchmarks """
+    config.add_route('bench_nested', '/bench/nested')
+    config.add_view('steward.bench.do_nested', route_name='bench_nested',
+                    renderer='json', permission='bench')
+
+
+class BenchApp(object):
+
+    """
+    A steward app with a single admin user
+
+    Parameters
+    ----------
+    auth_db : str, optional
+        Either 'settings' or 'yaml' (default 'settings')
+    settings : dict, optional
+        Extra settings for the app
+
+    Notes
+    -----
+    The password is hashed with the fewest rounds that passlib allows so that
+    the login benchmarks measure steward instead of the hash function.
+
+    """
+    def __init__(self, auth_db='settings', settings=None):
+        self.tempdir = None
+        password = sha256_crypt.encrypt(PASSWORD, rounds=1000)
+        app_settings = dict(BENCH_SETTINGS)
+        if auth_db == 'yaml':
+            self.tempdir = tempfile.mkdtemp()
+            filename = os.path.join(self.tempdir, 'users.yaml')
+            with open(filename, 'w') as outfile:
+                yaml.safe_dump({'users': {USERID: password},
+                                'groups': {USERID: ['admin']}}, outfile)
+            app_settings['steward.auth.db'] = filename
+        else:
+            app_settings['steward.auth.%s.pass' % USERID] = password
+            app_settings['steward.auth.%s.groups' % USERID] = 'admin'
+        app_settings.update(settings or {})
+        self.app = main({}, **app_settings)
+        self.cookie = None
+
+    def request(self, path, params=None):
+        """ Send a POST to the app and return the response """
+        req = Request.blank(path, POST=params or {})
+        if self.cookie is not None:
+            req.headers['Cookie'] = self.cookie
+        return req.get_response(self.app)
+
+    def login(self):
+        """ Log in and store the auth cookie """
+        response = self.request('/auth', {'userid': USERID,
+                                          'password': PASSWORD})
+        self.cookie = response.headers['Set-Cookie'].split(';')[0]
+        return response
+
+    def close(self):
+        """ Remove any temporary files """
+        if self.tempdir is not None:
+            shutil.rmtree(self.tempdir)
+
+
+def _bench_login(auth_db):
+    """ Create a benchmark that logs in with an auth db """
+    def setup(settings):
+        """ Create the app """
+        app = BenchApp(auth_db, settings)
+        return app, app.login
+    return setup
+
+
+def _bench_request(path, params=None):
+    """ Create a benchmark that makes authenticated requests to a path """
+    def setup(settings):
+        """ Create the app and log in """
+        app = BenchApp('settings', settings)
+        app.login()
+        return app, lambda: app.request(path, params)
+    return setup
+
+
+SCENARIOS = {
+    'login_settings': _bench_login('settings'),
+    'login_yaml': _bench_login('yaml'),
+    'check_auth': _bench_request('/check_auth'),
+    'acl': _bench_request('/bench/nested'),
+    'subreq': _bench_request('/bench/nested', {'depth': 1}),
+    'nested_subreq': _bench_request('/bench/nested', {'depth': 5}),
+}
+
+
+def run_scenario(setup, iterations=1000, warmup=50, settings=None):
+    """
+    Run a benchmark scenario
+
+    Parameters
+    ----------
+    setup : callable
+        Function that takes the app settings and returns a ``(BenchApp,
+        function)`` tuple. The function makes one request.
+    iterations : int, optional
+        The number of timed requests (default 1000)
+    warmup : int, optional
+        The number of untimed requests to make first (default 50)
+    settings : dict, optional
+        Extra settings for the app
+
+    Returns
+    -------
+    result : dict
+        The ``throughput`` (requests/sec), ``p50``, ``p95``, ``p99``, and
+        ``mean`` latencies (seconds), and the number of ``errors``
+
+    """
+    app, func = setup(settings)
+    try:
+        for _ in xrange(warmup):
+            func()
+        latencies = []
+        errors = 0
+        start = time.time()
+        for _ in xrange(iterations):
+            req_start = time.time()
+            response = func()
+            latencies.append(time.time() - req_start)
+            if response.status_int >= 400:
+                errors += 1
+        elapsed = time.time() - start
+    finally:
+        app.close()
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'errors': errors,
+        'throughput': iterations / elapsed if elapsed else 0,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def compare(results, baseline, threshold=10):
+    """
+    Compare benchmark results with a baseline
+
+    Parameters
+    ----------
+    results : dict
+        Mapping of scenario names to the output of :func:`run_scenario`
+    baseline : dict
+        Results in the same format from a previous run
+    threshold : float, optional
+        A scenario has regressed if its throughput dropped or its p95 latency
+        rose by more than this percent (default 10)
+
+    Returns
+    -------
+    regressions : list
+        Names of the scenarios that regressed
+
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        throughput = 100.0 * (result['throughput'] / old['throughput'] - 1)
+        p95 = 100.0 * (result['p95'] / old['p95'] - 1)
+        if throughput < -threshold or p95 > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def _format_row(name, result, baseline=None):
+    """ Format a line of the results table """
+    row = '%-16s %10.1f %9.3f %9.3f %9.3f %7d' % (
+        name, result['throughput'], 1000 * result['p50'],
+        1000 * result['p95'], 1000 * result['p99'], result['errors'])
+    if baseline is not None:
+        row += ' %+8.1f%%' % (100.0 * (result['throughput'] /
+                                        baseline['throughput'] - 1))
+    return row
+
+
+def run_bench():
+    """ Benchmark steward's core request paths """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description=run_bench.__doc__)
+    parser.add_argument('scenarios', nargs='*',
+                        help="Scenarios to run (default all). Choices: %s" %
+                        ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('-n', type=int, default=1000,
+                        help="Requests per scenario (default %(default)s)")
+    parser.add_argument('-w', '--warmup', type=int, default=50,
+                        help="Untimed requests per scenario "
+                        "(default %(default)s)")
+    parser.add_argument('-s', '--set', action='append', default=[],
+                        metavar='KEY=VALUE', help="Extra app setting")
+    parser.add_argument('--save', help="Write the results to this file")
+    parser.add_argument('--baseline',
+                        help="Compare the results with this file")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="Percent change that counts as a regression "
+                        "(default %(default)s)")
+    args = parser.parse_args()
+
+    names = args.scenarios or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario '%s'" % name)
+    settings = dict(item.split('=', 1) for item in args.set)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+
+    print '%-16s %10s %9s %9s %9s %7s' % ('scenario', 'req/s', 'p50 ms',
+                                          'p95 ms', 'p99 ms', 'errors')
+    results = {}
+    for name in names:
+        result = results[name] = run_scenario(SCENARIOS[name], args.n,
+                                              args.warmup, settings)
+        old = baseline.get(name) if baseline is not None else None
+        print _format_row(name, result, old)
+
+    if args.save is not None:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print "Regressions: %s" % ', '.join(regressions)
+            sys.exit(1)
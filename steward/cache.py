@@ -0,0 +1,116 @@
+""" HTTP caching of read-only views """
+import calendar
+import functools
+import hashlib
+import time
+from pyramid.response import Response
+
+from steward.util import LRUCache
+
+
+class CachedResponse(object):
+
+    """
+    A rendered view response stored in the view cache
+
+    Parameters
+    ----------
+    response : :class:`pyramid.response.Response`
+        The response to store. Only the body and content type are kept;
+        headers such as Set-Cookie are never cached.
+    ttl : float
+        Number of seconds that the entry is fresh for
+
+    """
+    def __init__(self, response, ttl):
+        self.body = response.body
+        self.content_type = response.content_type
+        self.charset = response.charset
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.last_modified = int(time.time())
+        self.expires = time.time() + ttl
+
+    def not_modified(self, request):
+        """ Check if the client's copy of the response is still valid """
+        if request.if_none_match:
+            return self.etag in request.if_none_match
+        if request.if_modified_since is not None:
+            return self.last_modified <= \
+                calendar.timegm(request.if_modified_since.utctimetuple())
+        return False
+
+    def respond(self, request):
+        """ Create a response (or a 304) for a request """
+        response = Response(content_type=self.content_type,
+                            charset=self.charset)
+        response.etag = self.etag
+        response.last_modified = self.last_modified
+        response.cache_control = 'private, max-age=%d' % \
+            max(0, self.expires - time.time())
+        if self.not_modified(request):
+            response.status_int = 304
+            response.content_type = None
+        else:
+            response.body = self.body
+        return response
+
+
+def _cache_key(request, shared):
+    """ Build the key for the view cache """
+    principals = () if shared else \
+        tuple(sorted(request.effective_principals))
+    return (request.path_qs, hashlib.sha1(request.body).digest(), principals)
+
+
+def cache_view(ttl=60, shared=False):
+    """
+    View decorator that caches the rendered response
+
+    Pass it to ``add_view`` or ``view_config`` with the ``decorator``
+    argument, so that it runs after the permission check::
+
+        config.add_view('myext.views.do_list', route_name='list',
+                        renderer='json', decorator=cache_view(ttl=300))
+
+    Responses are cached per set of effective principals, and per path and
+    request body. They are sent with an ETag, a Last-Modified, and a
+    ``Cache-Control: max-age`` for the time the entry has left, and
+    conditional requests that match get a 304. Only 200 responses with a
+    complete body are cached.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        Number of seconds to cache the response (default 60)
+    shared : bool, optional
+        If True, all users share one cache entry. Only use this if the
+        response does not depend on who is asking. (default False)
+
+    """
+    def decorator(view):
+        """ Wrap the view """
+        @functools.wraps(view)
+        def cached_view(context, request):
+            """ Return the cached response if there is one """
+            if request.environ.get('steward.subreq.inprocess'):
+                return view(context, request)
+            cache = request.registry.view_cache
+            key = _cache_key(request, shared)
+            entry = cache.get(key)
+            if entry is None:
+                response = view(context, request)
+                if response.status_int != 200 or \
+                        response.content_length is None:
+                    return response
+                entry = CachedResponse(response, ttl)
+                cache.set(key, entry, ttl)
+            return entry.respond(request)
+        return cached_view
+    return decorator
+
+
+def includeme(config):
+    """ Configure the app """
+    settings = config.get_settings()
+    config.registry.view_cache = LRUCache(
+        int(settings.get('steward.cache.size', 1000)))
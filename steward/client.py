@@ -2,28 +2,164 @@
 import cPickle as pickle
 import os
 import stat
+import sys
 import types
 
 import functools
 import getpass
+import imp
 import inspect
 import json
 import logging
 import requests
+import threading
 import shlex
 import subprocess
+import time
 import traceback
+import re
+import urllib
+import zlib
+from Queue import Queue, Empty
 from cmd import Cmd
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 from pyramid.httpexceptions import exception_response
 from pyramid.path import DottedNameResolver
-from threading import Thread, Lock
+from requests.adapters import HTTPAdapter
+from threading import Thread, Lock, RLock
+
+from steward import colors
+from steward.retry import (CircuitBreaker, CircuitOpenError, RetryPolicy,
+                           RETRY_STATUSES)
+from steward.util import LRUCache, percentile
 
 
 LOG = logging.getLogger(__name__)
 
 DEFAULT_INCLUDES = ['steward.base']
 
+NDJSON = 'application/x-ndjson'
+
+# Auth tickets are trusted for this fraction of their timeout
+TICKET_MARGIN = 0.9
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+SERVER_TIMING_RE = re.compile(r'dur=([\d.]+)')
+
+# While a command is being timed, the responses it receives are collected in
+# ``_RESPONSE_LOG.responses``
+_RESPONSE_LOG = threading.local()
+
+
+def parse_args(arglist):
+    """
+    Parse a command argument string into positional and keyword arguments
+
+    Parameters
+    ----------
+    arglist : str
+        The argument string, e.g. ``"foo bar=baz"``
+
+    Returns
+    -------
+    args : list
+    kwargs : dict
+
+    """
+    args = []
+    kwargs = {}
+    if arglist:
+        for arg in shlex.split(arglist):
+            if '=' in arg:
+                split = arg.split('=')
+                kwargs[split[0]] = split[1]
+            else:
+                args.append(arg)
+    return args, kwargs
+
+
+def _module_stamp(name):
+    """
+    Get the modification time of a module without importing it
+
+    This checks the top-level package (which changes when it is reinstalled)
+    and the file of the module itself.
+
+    """
+    parts = name.split('.')
+    try:
+        infile, path, _ = imp.find_module(parts[0])
+    except ImportError:
+        return None
+    if infile is not None:
+        infile.close()
+        return os.path.getmtime(path)
+    stamps = [os.path.getmtime(path)]
+    subpath = os.path.join(path, *parts[1:])
+    for filename in (subpath + '.py', os.path.join(subpath, '__init__.py')):
+        if os.path.exists(filename):
+            stamps.append(os.path.getmtime(filename))
+    return max(stamps)
+
+
+def _fresh_until(response):
+    """ Get the time until which a response may be used without revalidation """
+    cache_control = response.headers.get('Cache-Control', '')
+    match = MAX_AGE_RE.search(cache_control)
+    if match is None or 'no-cache' in cache_control:
+        return 0
+    return time.time() + int(match.group(1))
+
+
+def _server_time(response):
+    """ Get the server-side duration of a request in seconds, if known """
+    match = SERVER_TIMING_RE.search(response.headers.get('Server-Timing', ''))
+    if match is None:
+        return None
+    return float(match.group(1)) / 1000
+
+
+class _QuietStdout(object):
+
+    """
+    Wrapper for ``sys.stdout`` that discards output on some threads
+
+    Output is discarded on threads that set ``quiet`` to True. All other
+    threads write to the wrapped stream as usual.
+
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        self._devnull = open(os.devnull, 'w')
+
+    @property
+    def quiet(self):
+        """ True if output on the current thread is discarded """
+        return getattr(self._local, 'quiet', False)
+
+    @quiet.setter
+    def quiet(self, quiet):
+        """ Setter for quiet """
+        self._local.quiet = quiet
+
+    def __getattr__(self, name):
+        return getattr(self._devnull if self.quiet else self.stream, name)
+
+    def close(self):
+        """ Close the stream used for discarded output """
+        self._devnull.close()
+
+
+def _cookie_value(cookies, name):
+    """ Get the value of a cookie, or None if it is not in the jar """
+    for cookie in cookies:
+        if cookie.name == name:
+            return cookie.value
+    return None
+
 
 def repl_command(fxn):
     """
@@ -36,20 +172,832 @@ def repl_command(fxn):
     @functools.wraps(fxn)
     def wrapper(self, arglist):
         """Wraps the command method"""
-        args = []
-        kwargs = {}
-        if arglist:
-            for arg in shlex.split(arglist):
-                if '=' in arg:
-                    split = arg.split('=')
-                    kwargs[split[0]] = split[1]
-                else:
-                    args.append(arg)
+        args, kwargs = parse_args(arglist)
         return fxn(self, *args, **kwargs)
     return wrapper
 
 
-class StewardREPL(Cmd):
+class StewardClient(object):
+
+    """
+    Client for running commands on a steward server
+
+    Attributes
+    ----------
+    conf : dict
+        The client configuration
+    host : str
+        The address of the primary server
+    hosts : list
+        The addresses of all configured servers. The first one is ``host``.
+    host_groups : dict
+        Mapping of group names to lists of server addresses
+    session : :class:`requests.Session`
+        The pooled, keep-alive HTTP session used for all server requests
+    cookies : :class:`requests.cookies.RequestsCookieJar`
+        The cookie jar of the session. Contains credentials.
+    tickets : dict
+        Mapping of host to the ``issued`` time, ``timeout``, and
+        ``reissue_time`` of its auth ticket. Saved with the cookies.
+    reauth : callable
+        If set, this is called with no arguments to log in again when a
+        command fails with a 403 because the auth ticket expired. The command
+        is then retried once.
+    response_cache : :class:`~steward.util.LRUCache`
+        Cache of responses that had an ETag or Last-Modified header. Fresh
+        responses (per ``Cache-Control: max-age``) are returned without
+        contacting the server. Stale ones are revalidated with a conditional
+        request. None if disabled.
+    retry_policy : :class:`~steward.retry.RetryPolicy`
+        Which commands are idempotent, and how often to retry them
+    breakers : dict
+        Mapping of host to its :class:`~steward.retry.CircuitBreaker`. Empty
+        if circuit breaking is disabled.
+    hedge_after : float
+        If set and there are several hosts, an idempotent command that gets no
+        response from its host within this many seconds is also sent to
+        another host, and the first good response is used.
+
+    """
+    conf = {}
+    host = None
+    hosts = ()
+    host_groups = {}
+    fanout_timeout = None
+    compress_min_size = None
+    session = None
+    cookies = None
+    timeout = None
+    request_params = {}
+    tickets = {}
+    reauth = None
+    name_resolver = DottedNameResolver(__package__)
+    response_cache = None
+    retry_policy = RetryPolicy()
+    breakers = {}
+    breaker_threshold = 0
+    breaker_timeout = 30
+    hedge_after = None
+    _auth_lock = None
+    _auth_generation = 0
+    _last_response = None
+
+    def configure(self, conf):
+        """
+        Set up the connection to the server and load any saved credentials
+
+        Parameters
+        ----------
+        conf : dict
+            Configuration dictionary
+
+        """
+        self.conf = conf
+        hosts = conf['host']
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        self.hosts = list(hosts)
+        self.host = self.hosts[0]
+        self.host_groups = conf.get('host_groups', {})
+        self.fanout_timeout = conf.get('fanout_timeout')
+        if conf.get('compress_requests'):
+            self.compress_min_size = conf.get('compress_min_size', 1024)
+        self.request_params = conf.get('request_params', {})
+        if conf.get('response_cache', True):
+            self.response_cache = LRUCache(conf.get('response_cache_size',
+                                                    100))
+        self.retry_policy = RetryPolicy.from_conf(conf)
+        self.breakers = {}
+        self.breaker_threshold = conf.get('circuit_breaker_threshold', 0)
+        self.breaker_timeout = conf.get('circuit_breaker_timeout', 30)
+        self.hedge_after = conf.get('hedge_after')
+        self.tickets = {}
+        self._auth_lock = RLock()
+        self._create_session(conf)
+        self._load_cookies()
+
+    def _create_session(self, conf):
+        """
+        Create the pooled HTTP session that all requests are sent through
+
+        Parameters
+        ----------
+        conf : dict
+            Configuration dictionary
+
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=conf.get('pool_connections', 10),
+            pool_maxsize=conf.get('pool_maxsize', 10),
+            pool_block=conf.get('pool_block', False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not conf.get('keep_alive', True):
+            self.session.headers['Connection'] = 'close'
+        self.timeout = (conf.get('connect_timeout'), conf.get('read_timeout'))
+        self.cookies = self.session.cookies
+
+    def _post(self, uri, host=None, **kwargs):
+        """
+        Send a POST request to the server through the pooled session
+
+        Parameters
+        ----------
+        uri : str
+            The uri path to use
+        host : str, optional
+            The server to send the request to (default :attr:`host`)
+        **kwargs : dict
+            Keyword arguments for :meth:`requests.Session.post`
+
+        """
+        params = dict(self.request_params)
+        params.setdefault('timeout', self.timeout)
+        if 'headers' in kwargs and 'headers' in params:
+            headers = dict(params['headers'])
+            headers.update(kwargs.pop('headers'))
+            params['headers'] = headers
+        params.update(kwargs)
+        host = host or self.host
+        response = self.session.post(host + uri, **params)
+        log = getattr(_RESPONSE_LOG, 'responses', None)
+        if log is not None:
+            log.append(response)
+        ticket = self.tickets.get(host)
+        if ticket is not None and uri != '/auth' and \
+                'Set-Cookie' in response.headers:
+            value = _cookie_value(response.cookies,
+                                  ticket.get('cookie_name', 'auth_tkt'))
+            if value and value != ticket.get('value'):
+                # The server reissued the auth ticket
+                ticket['issued'] = time.time()
+                ticket['value'] = value
+                self._save_cookies()
+        return response
+
+    def pool_stats(self):
+        """
+        Get the connection pool statistics for the session
+
+        Returns
+        -------
+        stats : dict
+            Mapping of host to a dict with the number of ``requests`` sent,
+            the number of new ``connections`` made (pool misses), and the
+            number of ``reused`` connections (pool hits)
+
+        """
+        stats = {}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                name = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+                stats[name] = {
+                    'requests': pool.num_requests,
+                    'connections': pool.num_connections,
+                    'reused': pool.num_requests - pool.num_connections,
+                }
+        return stats
+
+    def _ticket_valid(self, host=None):
+        """ Check if the saved auth ticket for a host is known to be valid """
+        ticket = self.tickets.get(host or self.host)
+        if ticket is None:
+            return False
+        if ticket['timeout'] is None:
+            return True
+        return time.time() < ticket['issued'] + \
+            TICKET_MARGIN * ticket['timeout']
+
+    def _record_ticket(self, host, response):
+        """ Store the auth ticket metadata returned by /auth """
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and 'timeout' in data:
+            cookie_name = data.get('cookie_name', 'auth_tkt')
+            self.tickets[host] = {
+                'issued': time.time(),
+                'timeout': data['timeout'],
+                'reissue_time': data.get('reissue_time'),
+                'cookie_name': cookie_name,
+                'value': _cookie_value(response.cookies, cookie_name),
+            }
+        else:
+            # Older servers don't tell us when the ticket expires
+            self.tickets.pop(host, None)
+
+    def _check_auth(self, host=None):
+        """ Ask the server if the auth cookie is valid """
+        response = self._post('/check_auth', host=host,
+                              allow_redirects=False)
+        return response.ok and response.json() is not None
+
+    def _needs_auth(self):
+        """
+        Check if the user needs to supply a password
+
+        This only asks the server if the saved auth ticket may have expired.
+
+        """
+        if self._ticket_valid():
+            return False
+        return not self._check_auth()
+
+    def _reauthenticate(self, host, generation):
+        """
+        Log in again after a command to a host failed with a 403
+
+        Parameters
+        ----------
+        host : str
+            The host that returned the 403
+        generation : int
+            The value of ``_auth_generation`` when the command was sent
+
+        Returns
+        -------
+        retry : bool
+            True if the command should be retried
+
+        """
+        if self.reauth is None:
+            return False
+        with self._auth_lock:
+            if self._auth_generation != generation:
+                # Another thread already logged in again
+                return True
+            self.tickets.pop(host, None)
+            if self._check_auth(host):
+                # The ticket is fine, the user just isn't allowed to do this
+                return False
+            self.reauth()
+            return True
+
+    def _auth(self, userid, password):
+        """
+        Authenticate the user with the Steward server
+
+        If there are multiple hosts configured, this will attempt to log in to
+        all of them, but only a failure on the primary host is an error.
+
+        """
+        data = {
+            'userid': userid,
+            'password': password,
+        }
+        response = self._post('/auth', data=data, allow_redirects=False)
+        if not response.ok:
+            raise exception_response(response.status_code)
+        self._record_ticket(self.host, response)
+        request_kwargs = {}
+        if self.fanout_timeout is not None:
+            request_kwargs['timeout'] = self.fanout_timeout
+        for host in self.hosts[1:]:
+            try:
+                response = self._post('/auth', host=host, data=data,
+                                      allow_redirects=False, **request_kwargs)
+                if response.ok:
+                    self._record_ticket(host, response)
+                else:
+                    LOG.warning("Login to %s failed: %d", host,
+                                response.status_code)
+            except requests.RequestException as e:
+                LOG.warning("Login to %s failed: %s", host, e)
+        self._auth_generation += 1
+        if self.response_cache is not None:
+            # Cached responses may belong to the previous user
+            self.response_cache.clear()
+        self._save_cookies()
+
+    def _save_cookies(self):
+        """ Save the auth cookies and ticket metadata to a file """
+        filename = self._cookie_file()
+        if filename is None:
+            return
+        mode = stat.S_IRUSR | stat.S_IWUSR
+        # Requests on other threads may save at the same time
+        with self._auth_lock:
+            outfile = None
+            try:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                outfile = os.fdopen(os.open(filename, flags, mode), 'w')
+                pickle.dump({'cookies': self.cookies,
+                             'tickets': self.tickets}, outfile)
+            finally:
+                if outfile is not None:
+                    outfile.close()
+
+    def _load_cookies(self):
+        """ Load the auth cookies and ticket metadata from a file """
+        filename = self._cookie_file()
+        if filename is None or not os.path.exists(filename):
+            return
+        with open(filename, 'r') as infile:
+            data = pickle.load(infile)
+        if isinstance(data, dict):
+            self.cookies.update(data['cookies'])
+            self.tickets.update(data['tickets'])
+        else:
+            # Old cookie files only contain the cookie jar
+            self.cookies.update(data)
+
+    def _cookie_file(self):
+        """ Get the cookie file """
+        return self.conf.get('cookie_file',
+                             os.path.join(os.environ.get('HOME', '.'),
+                                                  '.steward_cookie'))
+
+    def cmd(self, uri, **kwargs):
+        """
+        Run a command on the steward server
+
+        Parameters
+        ----------
+        uri : str
+            The uri path to use
+        kwargs : dict
+            The parameters to pass up in the request
+
+        """
+        return self._cmd(self.host, uri, kwargs, hedge=True)
+
+    def cmd_stream(self, uri, **kwargs):
+        """
+        Run a command and yield the results as they arrive
+
+        If the endpoint streams its results (by returning an iterator), each
+        item is yielded as soon as it is received. Otherwise the whole
+        response is yielded as a single item.
+
+        Parameters
+        ----------
+        uri : str
+            The uri path to use
+        kwargs : dict
+            The parameters to pass up in the request
+
+        """
+        response = self._cmd(self.host, uri, kwargs, stream=True,
+                             headers={'Accept': NDJSON + ', application/json'})
+        try:
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith(NDJSON):
+                yield response.json()
+                return
+            # With chunked transfer encoding, process each chunk as soon as
+            # it arrives. Otherwise we have to read fixed-size blocks.
+            chunk_size = None if getattr(response.raw, 'chunked', False) \
+                else 512
+            for line in response.iter_lines(chunk_size=chunk_size):
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    def subscribe(self, topics=None, reconnect=True):
+        """
+        Subscribe to events published on the server
+
+        Parameters
+        ----------
+        topics : list, optional
+            List of topic patterns (e.g. ``'deploy.*'``) to subscribe to
+            (default all)
+        reconnect : bool, optional
+            If True, connect again when the server closes the connection,
+            which it does after ``steward.events.max_duration`` seconds.
+            (default True)
+
+        Returns
+        -------
+        events : generator
+            Yields ``(topic, data)`` tuples as the events arrive
+
+        """
+        while True:
+            response = self._cmd(self.host, '/events',
+                                 {'topics': topics or []}, stream=True,
+                                 timeout=(self.timeout[0], None))
+            try:
+                chunk_size = None if getattr(response.raw, 'chunked', False) \
+                    else 1
+                topic, data = None, []
+                for line in response.iter_lines(chunk_size=chunk_size):
+                    if line.startswith('event:'):
+                        topic = line[6:].strip()
+                    elif line.startswith('data:'):
+                        data.append(line[5:].strip())
+                    elif not line and topic is not None:
+                        yield topic, json.loads('\n'.join(data))
+                        topic, data = None, []
+            finally:
+                response.close()
+            if not reconnect:
+                return
+
+    def _cmd(self, host, uri, kwargs, hedge=False, **request_kwargs):
+        """
+        Run a command on a specific steward server
+
+        Parameters
+        ----------
+        host : str
+            The address of the server
+        uri : str
+            The uri path to use
+        kwargs : dict
+            The parameters to pass up in the request
+        hedge : bool, optional
+            If True, an idempotent command may also be sent to another host
+            (see ``hedge_after``). Only use this when any host can answer.
+            (default False)
+        **request_kwargs : dict
+            Keyword arguments for :meth:`requests.Session.post`
+
+        """
+        if not uri.startswith('/'):
+            uri = '/' + uri
+        for key, value in kwargs.items():
+            if type(value) not in (int, float, bool, str, unicode):
+                kwargs[key] = json.dumps(value)
+        key = cached = None
+        if self.response_cache is not None:
+            key = (host, uri, tuple(sorted(kwargs.items())))
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                if cached['expires'] > time.time():
+                    self._last_response = cached['response']
+                    return cached['response']
+                request_kwargs['headers'] = self._validator_headers(
+                    cached, request_kwargs.get('headers'))
+        data = kwargs
+        if self.compress_min_size is not None:
+            data = self._compress_body(kwargs, request_kwargs)
+        generation = self._auth_generation
+        answered, response = self._send(host, uri, data, request_kwargs,
+                                        hedge)
+        if response.status_code == 403 and \
+                self._reauthenticate(answered, generation):
+            response.close()
+            generation = self._auth_generation
+            answered, response = self._send(host, uri, data, request_kwargs,
+                                            hedge)
+        if cached is not None and response.status_code == 304:
+            response.close()
+            cached['expires'] = _fresh_until(response)
+            response = cached['response']
+        elif key is not None and response.ok and \
+                generation == self._auth_generation:
+            # Don't cache a response if a different user logged in meanwhile.
+            # The validators are only good for the host that sent them.
+            self._cache_response((answered,) + key[1:], response)
+        self._last_response = response
+        if not response.ok:
+            try:
+                data = response.json()
+            except:
+                data = None
+            kw = {}
+            if data is not None:
+                kw['detail'] = data['detail']
+            raise exception_response(response.status_code, **kw)
+        return response
+
+    def _breaker(self, host):
+        """ Get the circuit breaker for a host, or None if disabled """
+        if not self.breaker_threshold:
+            return None
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers.setdefault(
+                host, CircuitBreaker(self.breaker_threshold,
+                                     self.breaker_timeout))
+        return breaker
+
+    def _checked_post(self, host, uri, data, request_kwargs):
+        """ Send a request through the host's circuit breaker """
+        breaker = self._breaker(host)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError("Circuit open for %s" % host)
+        try:
+            response = self._post(uri, host=host, data=data,
+                                  **request_kwargs)
+            if breaker is not None:
+                if response.status_code in RETRY_STATUSES:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+        except requests.RequestException:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        finally:
+            # If anything else went wrong, let another trial request through
+            if breaker is not None:
+                breaker.cancel_trial()
+        return response
+
+    def _hedged_post(self, host, backup, uri, data, request_kwargs):
+        """
+        Send a request, and send it to a backup host as well if it is slow
+
+        The request is also sent to the backup host right away if the first
+        host fails. Returns the host and the first response that is not a
+        server error, or the last result if both fail.
+
+        """
+        results = Queue()
+
+        def run(target):
+            """ Send the request to one host """
+            try:
+                results.put((target, self._checked_post(target, uri, data,
+                                                        request_kwargs), None))
+            except Exception as e:  # pylint: disable=W0703
+                # The caller raises it, so it must not be lost here
+                results.put((target, None, e))
+
+        def launch(target):
+            """ Start a request in the background """
+            worker = Thread(target=run, args=(target,))
+            worker.daemon = True
+            worker.start()
+
+        launch(host)
+        pending = 1
+        received = []
+        try:
+            received.append(results.get(timeout=self.hedge_after))
+            pending -= 1
+            response = received[-1][1]
+            if response is None or response.status_code in RETRY_STATUSES:
+                LOG.debug("Sending %s to %s after a failure", uri, backup)
+                launch(backup)
+                pending += 1
+        except Empty:
+            LOG.debug("Hedging %s to %s", uri, backup)
+            launch(backup)
+            pending += 1
+        while pending:
+            response = received[-1][1] if received else None
+            if response is not None and \
+                    response.status_code not in RETRY_STATUSES:
+                break
+            received.append(results.get())
+            pending -= 1
+
+        winner = received[-1]
+        for _, response, _ in received[:-1]:
+            if response is not None:
+                response.close()
+        if pending:
+            def drain():
+                """ Release the connection of the slower request """
+                _, response, _ = results.get()
+                if response is not None:
+                    response.close()
+            drainer = Thread(target=drain)
+            drainer.daemon = True
+            drainer.start()
+        target, response, error = winner
+        if error is not None:
+            raise error
+        return target, response
+
+    def _send(self, host, uri, data, request_kwargs, hedge=False):
+        """
+        Send a command, retrying and hedging it if it is idempotent
+
+        Connection errors and server errors (5xx) are retried with jittered
+        exponential backoff, up to ``retry_policy.retries`` times. The command
+        is only hedged to another host if ``hedge`` is True.
+
+        Returns
+        -------
+        host : str
+            The host that answered, which may be a backup host if the command
+            was hedged
+        response : :class:`requests.Response`
+
+        """
+        idempotent = self.retry_policy.is_idempotent(uri)
+        backup = None
+        if hedge and idempotent and self.hedge_after is not None:
+            for other in self.hosts:
+                if other != host:
+                    breaker = self._breaker(other)
+                    if breaker is None or breaker.state == 'closed':
+                        backup = other
+                        break
+        attempts = 1 + (self.retry_policy.retries if idempotent else 0)
+        for attempt in xrange(attempts):
+            if attempt:
+                time.sleep(self.retry_policy.delay(attempt))
+            last_attempt = attempt + 1 == attempts
+            try:
+                if backup is not None:
+                    answered, response = self._hedged_post(
+                        host, backup, uri, data, request_kwargs)
+                else:
+                    answered = host
+                    response = self._checked_post(host, uri, data,
+                                                  request_kwargs)
+            except requests.RequestException as e:
+                if last_attempt:
+                    raise
+                LOG.debug("Retrying %s on %s after error: %s", uri, host, e)
+                continue
+            if last_attempt or response.status_code not in RETRY_STATUSES:
+                return answered, response
+            LOG.debug("Retrying %s on %s after status %d", uri, host,
+                      response.status_code)
+            response.close()
+
+    def _validator_headers(self, cached, headers=None):
+        """ Add the conditional request headers for a cached response """
+        headers = dict(headers or {})
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def _cache_response(self, key, response):
+        """ Store a response in the cache if it has validators """
+        headers = response.headers
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag is None and last_modified is None or \
+                'no-store' in headers.get('Cache-Control', '') or \
+                'Content-Length' not in headers:
+            return
+        # Read the body so that the response can be reused
+        response.content  # pylint: disable=W0104
+        self.response_cache.set(key, {
+            'response': response,
+            'etag': etag,
+            'last_modified': last_modified,
+            'expires': _fresh_until(response),
+        })
+
+    def _compress_body(self, kwargs, request_kwargs):
+        """
+        Gzip the encoded request parameters if they are large enough
+
+        Parameters
+        ----------
+        kwargs : dict
+            The parameters to pass up in the request
+        request_kwargs : dict
+            The keyword arguments for :meth:`requests.Session.post`. If the
+            body is compressed, the headers will be added to this.
+
+        Returns
+        -------
+        data : dict or str
+            Either the original parameters or the compressed body
+
+        """
+        body = urllib.urlencode(dict(
+            (key, value.encode('utf-8') if isinstance(value, unicode) else
+             value) for key, value in kwargs.iteritems()))
+        if len(body) < self.compress_min_size:
+            return kwargs
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        LOG.debug("Compressed request %d -> %d bytes", len(body),
+                  len(compressed))
+        headers = dict(request_kwargs.get('headers', {}))
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request_kwargs['headers'] = headers
+        return compressed
+
+    def resolve_hosts(self, hosts=None):
+        """
+        Get a list of server addresses
+
+        Parameters
+        ----------
+        hosts : str or list, optional
+            The name of a group in ``host_groups`` (optionally prefixed with
+            '@'), a single address, or a list of addresses. Defaults to all
+            configured hosts.
+
+        Returns
+        -------
+        hosts : list
+
+        """
+        if hosts is None:
+            return list(self.hosts)
+        if isinstance(hosts, basestring):
+            name = hosts.lstrip('@')
+            if name in self.host_groups:
+                return list(self.host_groups[name])
+            elif hosts.startswith('@'):
+                raise KeyError("Unknown host group '%s'" % name)
+            return [hosts]
+        return list(hosts)
+
+    def fanout(self, uri, params=None, hosts=None, timeout=None):
+        """
+        Run the same command on many servers in parallel
+
+        Parameters
+        ----------
+        uri : str
+            The uri path to use
+        params : dict, optional
+            The parameters to pass up in the request
+        hosts : str or list, optional
+            The servers to run on (see :meth:`resolve_hosts`)
+        timeout : float, optional
+            The maximum number of seconds to wait for each host (default
+            ``fanout_timeout`` from the config). Hosts that take longer are
+            reported with a :class:`requests.exceptions.Timeout`.
+
+        Returns
+        -------
+        results : generator
+            Yields ``(host, result, latency)`` tuples in the order that the
+            hosts respond. ``result`` is either the
+            :class:`requests.Response` or the exception that was raised.
+
+        """
+        if timeout is None:
+            timeout = self.fanout_timeout
+        hosts = self.resolve_hosts(hosts)
+        request_kwargs = {}
+        if timeout is not None:
+            request_kwargs['timeout'] = timeout
+        results = Queue()
+
+        def run(host):
+            """ Run the command on one host """
+            start = time.time()
+            try:
+                result = self._cmd(host, uri, dict(params or {}),
+                                   **request_kwargs)
+            except Exception as e:  # pylint: disable=W0703
+                result = e
+            results.put((host, result, time.time() - start))
+
+        start = time.time()
+        for host in hosts:
+            worker = Thread(target=run, args=(host,))
+            worker.daemon = True
+            worker.start()
+        pending = set(hosts)
+        while pending:
+            try:
+                if timeout is None:
+                    host, result, latency = results.get()
+                else:
+                    remaining = max(0, start + timeout - time.time())
+                    host, result, latency = results.get(timeout=remaining)
+            except Empty:
+                for host in pending:
+                    yield (host, requests.exceptions.Timeout(
+                        "No response after %ss" % timeout), timeout)
+                return
+            pending.discard(host)
+            yield host, result, latency
+
+    def batch(self, commands):
+        """
+        Run many commands on the steward server in a single request
+
+        Parameters
+        ----------
+        commands : list
+            List of ``(route, params)`` tuples or ``{'route': route, 'params':
+            params}`` dicts. ``route`` is either the name of the route to run
+            or its path (starting with '/').
+
+        Returns
+        -------
+        results : list
+            One dict per command, in order, with the ``status`` code and
+            either the ``result`` or the error ``detail``
+
+        """
+        payload = []
+        for command in commands:
+            if not isinstance(command, dict):
+                route, params = command
+                command = {'route': route, 'params': params}
+            payload.append(command)
+        return self.cmd('/batch', commands=payload).json()
+
+
+class StewardREPL(StewardClient, Cmd):
 
     """
     Interactive commandline interface
@@ -58,24 +1006,32 @@ class StewardREPL(Cmd):
     ----------
     aliases : dict
         Dictionary of aliased commands
-    host : str
-        The address of the server
-    cookies : str
-        The cookie dict. Contains credentials.
     running : bool
         True while session is active, False after quitting
+    verbose : bool
+        If True, print how long each step of startup took
+
+    Notes
+    -----
+    The commands that each extension registers are cached in a manifest file
+    (``manifest_file`` in the config). Extensions found in the manifest are
+    not imported at startup; their commands are registered as stubs that
+    import the extension the first time one of them is run.
 
     """
-    conf = {}
     aliases = {}
     running = False
-    host = None
-    cookies = None
-    name_resolver = DottedNameResolver(__package__)
+    verbose = False
     prompt = '==> '
-    request_params = {}
     attr_lock = Lock()
-    _last_response = None
+    _manifest = None
+    _manifest_dirty = False
+    _recording = None
+    _loaded_extensions = ()
+
+    def __init__(self, *args, **kwargs):
+        # Cmd is an old-style class, so super() would skip it
+        Cmd.__init__(self, *args, **kwargs)
 
     def initialize(self, conf):
         """
@@ -87,10 +1043,11 @@ class StewardREPL(Cmd):
             Configuration dictionary
 
         """
-        self.conf = conf
+        timings = []
+        start = time.time()
+        self.configure(conf)
+        timings.append(('configure', time.time() - start))
         self.identchars += './'
-        self.host = conf['host']
-        self.request_params = conf.get('request_params', {})
         if 'prompt' in conf:
             self.prompt = conf['prompt']
         self.aliases = {}
@@ -98,13 +1055,23 @@ class StewardREPL(Cmd):
             for alias, longvalue in conf['aliases'].iteritems():
                 self.do_alias(alias + ' ' + longvalue)
         self.running = True
-        self._load_cookies()
+        step = time.time()
+        self.reauth = self._login
         if self._needs_auth():
-            username = raw_input('Username: ')
-            password = getpass.getpass()
-            self._auth(username, password)
+            self._login()
+        timings.append(('auth', time.time() - step))
+        step = time.time()
+        self._loaded_extensions = set()
+        self._load_manifest()
         self._load_extensions(DEFAULT_INCLUDES)
         self._load_extensions(conf.get('includes', []))
+        self._save_manifest()
+        timings.append(('extensions', time.time() - step))
+        if self.verbose:
+            timings.append(('total', time.time() - start))
+            for name, duration in timings:
+                print >> sys.stderr, "startup: %-10s %8.1fms" % (
+                    name, 1000 * duration)
 
     def start(self):
         """ Start running the interactive session (blocking) """
@@ -119,61 +1086,61 @@ class StewardREPL(Cmd):
                     print self._last_response.text
                 traceback.print_exc()
 
-    def _needs_auth(self):
-        """ Check if the user needs to supply a password """
-        response = requests.post(self.host + '/check_auth',
-                                 cookies=self.cookies, allow_redirects=False,
-                                 **self.request_params)
-        return not response.ok or response.json() is None
-
-    def _auth(self, userid, password):
-        """ Authenticate the user with the Steward server """
-        data = {
-            'userid': userid,
-            'password': password,
-        }
-        response = requests.post(self.host + '/auth', data=data,
-                                 allow_redirects=False, **self.request_params)
-        if response.ok:
-            self.cookies = response.cookies
-            self._save_cookies()
-        else:
-            raise exception_response(response.status_code)
+    @repl_command
+    def do_pool_stats(self):
+        """ Print connection pool hit/miss statistics """
+        stats = self.pool_stats()
+        if not stats:
+            print "No connections"
+        for name, data in sorted(stats.items()):
+            print "%s: %d requests, %d connections, %d reused" % (
+                name, data['requests'], data['connections'], data['reused'])
 
-    def _save_cookies(self):
-        """ Save the auth cookies to a file """
-        filename = self._cookie_file()
-        if filename is None:
-            return
-        mode = stat.S_IRUSR | stat.S_IWUSR
-        outfile = None
-        try:
-            outfile = os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT,
-                                        mode), 'w')
-            pickle.dump(self.cookies, outfile)
-        finally:
-            if outfile is not None:
-                outfile.close()
+    def _login(self):
+        """ Prompt the user for credentials and log in """
+        username = raw_input('Username: ')
+        password = getpass.getpass()
+        self._auth(username, password)
 
+    def _manifest_file(self):
+        """ Get the extension manifest file """
+        return self.conf.get('manifest_file',
+                             os.path.join(os.environ.get('HOME', '.'),
+                                          '.steward_manifest'))
 
-    def _load_cookies(self):
-        """ Load the auth cookies from a file """
-        filename = self._cookie_file()
+    def _load_manifest(self):
+        """ Load the cached extension commands from the manifest file """
+        self._manifest = {}
+        self._manifest_dirty = False
+        filename = self._manifest_file()
         if filename is None or not os.path.exists(filename):
             return
-        with open(filename, 'r') as infile:
-            self.cookies = pickle.load(infile)
+        try:
+            with open(filename, 'r') as infile:
+                self._manifest = json.load(infile)
+        except ValueError:
+            LOG.warning("Ignoring corrupt manifest file %s", filename)
 
-    def _cookie_file(self):
-        """ Get the cookie file """
-        return self.conf.get('cookie_file',
-                             os.path.join(os.environ.get('HOME', '.'),
-                                                  '.steward_cookie'))
+    def _save_manifest(self):
+        """ Write the extension manifest file if it has changed """
+        filename = self._manifest_file()
+        if filename is None or not self._manifest_dirty:
+            return
+        try:
+            with open(filename, 'w') as outfile:
+                json.dump(self._manifest, outfile)
+            self._manifest_dirty = False
+        except IOError as e:
+            LOG.warning("Could not write manifest file %s: %s", filename, e)
 
     def _load_extensions(self, mods):
         """
         Load extensions modules
 
+        Extensions with an up-to-date entry in the manifest are not imported.
+        Their commands are registered as stubs that call
+        :meth:`_import_extension` when they are first run.
+
         Parameters
         ----------
         mods : list
@@ -181,10 +1148,60 @@ class StewardREPL(Cmd):
 
         """
         for mod in mods:
-            mod = self.name_resolver.maybe_resolve(mod)
-            loader = Thread(target=functools.partial(mod.include_client, self))
-            loader.daemon = True
-            loader.start()
+            entry = None
+            if isinstance(mod, basestring) and self._manifest is not None:
+                entry = self._manifest.get(mod)
+                if entry is not None and \
+                        entry.get('stamp') != _module_stamp(mod):
+                    entry = None
+            if entry is None:
+                try:
+                    self._import_extension(mod)
+                except Exception:  # pylint: disable=W0703
+                    LOG.exception("Error loading extension %s", mod)
+                continue
+            for name, doc in entry['commands'].iteritems():
+                self._set_lazy_cmd(mod, name, doc)
+            for name, args in entry['autocomplete'].iteritems():
+                self.set_autocomplete(name, args)
+
+    def _import_extension(self, mod):
+        """ Import an extension and record its commands in the manifest """
+        if mod in self._loaded_extensions:
+            return
+        self._loaded_extensions.add(mod)
+        if not isinstance(mod, basestring) or self._manifest is None:
+            self.name_resolver.maybe_resolve(mod).include_client(self)
+            return
+        self._recording = {
+            'stamp': _module_stamp(mod),
+            'commands': {},
+            'autocomplete': {},
+        }
+        try:
+            self.name_resolver.maybe_resolve(mod).include_client(self)
+            self._manifest[mod] = self._recording
+            self._manifest_dirty = True
+        finally:
+            self._recording = None
+
+    def _set_lazy_cmd(self, mod, name, doc):
+        """ Register a stub that imports an extension to run a command """
+        def wrapper(self, arglist):
+            """ Import the extension and run the real command """
+            self._import_extension(mod)
+            self._save_manifest()
+            function = getattr(self, 'do_' + name, None)
+            if function is None or \
+                    getattr(function, '__func__', None) is wrapper:
+                self.rm_cmd(name)
+                print "Command '%s' no longer exists in %s" % (name, mod)
+                return
+            return function(arglist)
+        wrapper.__doc__ = doc
+        bound_cmd = types.MethodType(wrapper, self, StewardREPL)
+        with self.attr_lock:
+            setattr(self, 'do_' + name, bound_cmd)
 
     def help_help(self):
         """Print the help text for help"""
@@ -253,6 +1270,8 @@ class StewardREPL(Cmd):
 
         """
         function = self.name_resolver.maybe_resolve(function)
+        if self._recording is not None:
+            self._recording['commands'][name] = function.__doc__
         if wrap:
             function = repl_command(function)
         bound_cmd = types.MethodType(function, self, StewardREPL)
@@ -261,6 +1280,9 @@ class StewardREPL(Cmd):
 
     def rm_cmd(self, name):
         """ Remove a command from the client """
+        if self._recording is not None:
+            self._recording['commands'].pop(name, None)
+            self._recording['autocomplete'].pop(name, None)
         with self.attr_lock:
             if hasattr(self, 'do_' + name):
                 delattr(self, 'do_' + name)
@@ -271,6 +1293,9 @@ class StewardREPL(Cmd):
 
     def set_autocomplete(self, command, args):
         """ Set a command to autocomplete the given arguments """
+        if self._recording is not None:
+            args = list(args)
+            self._recording['autocomplete'][command] = args
         def wrapper(self, text, line, begidx, endidx):
             """ A wrapper for a simple autocomplete implementation """
             # We have to do a little magic here because cmd.py apparently
@@ -288,39 +1313,209 @@ class StewardREPL(Cmd):
         with self.attr_lock:
             setattr(self, 'complete_' + command, bound_cmd)
 
-    def cmd(self, uri, **kwargs):
+    def do_batch(self, arglist):
         """
-        Run a command on the steward server
+        Run several commands in a single request
 
-        Parameters
-        ----------
-        uri : str
-            The uri path to use
-        kwargs : dict
-            The parameters to pass up in the request
+        Commands are separated by ';'
+
+        ``batch version; check_auth``
+
+        ``batch pkg/list; pkg/info name=foo``
 
         """
-        if not uri.startswith('/'):
-            uri = '/' + uri
-        url = self.host + uri
-        for key, value in kwargs.items():
-            if type(value) not in (int, float, bool, str, unicode):
-                kwargs[key] = json.dumps(value)
-        response = requests.post(url, data=kwargs, cookies=self.cookies,
-                                 **self.request_params)
-        self._last_response = response
-        if not response.ok:
+        commands = []
+        for command in arglist.split(';'):
+            args, kwargs = parse_args(command)
+            if not args:
+                continue
+            uri = args[0]
+            if not uri.startswith('/'):
+                uri = '/' + uri
+            commands.append((uri, kwargs))
+        for (route, _), result in zip(commands, self.batch(commands)):
+            if result['status'] == 200:
+                print route
+                pprint(result['result'])
+            else:
+                print "%s: %d %s" % (route, result['status'],
+                                     result['detail'])
+
+    def do_fanout(self, arglist):
+        """
+        Run a command on many servers in parallel
+
+        ``fanout version`` will run ``version`` on all configured hosts
+
+        ``fanout @web version`` will run ``version`` on the hosts in the
+        ``web`` host group
+
+        """
+        args, kwargs = parse_args(arglist)
+        hosts = None
+        if args and args[0].startswith('@'):
+            hosts = args.pop(0)
+        if not args:
+            raise TypeError("Must provide a command to run")
+        summary = []
+        for host, result, latency in self.fanout(args[0], kwargs, hosts):
+            if isinstance(result, Exception):
+                status = getattr(result, 'code', None) or \
+                    type(result).__name__
+                print colors.red("%s (%.3fs): %s" % (host, latency, result))
+            else:
+                status = result.status_code
+                print colors.green("%s (%.3fs)" % (host, latency))
+                try:
+                    pprint(result.json())
+                except ValueError:
+                    print result.text
+            summary.append((host, status, latency))
+        print
+        width = max([len(host) for host, _, _ in summary] + [4])
+        print "%-*s  %-10s  %s" % (width, 'host', 'status', 'latency')
+        for host, status, latency in sorted(summary, key=lambda x: x[2]):
+            print "%-*s  %-10s  %.3fs" % (width, host, status, latency)
+
+    def _timed_cmd(self, line):
+        """
+        Run a command line and measure how long it takes
+
+        Returns
+        -------
+        wall : float
+            Seconds that the command took
+        server : float or None
+            Total seconds the server spent on the command's requests, if the
+            server reported it
+        error : Exception or None
+            The exception raised by the command
+
+        """
+        _RESPONSE_LOG.responses = []
+        error = None
+        start = time.time()
+        try:
+            self.onecmd(line)
+        except Exception as e:  # pylint: disable=W0703
+            error = e
+        finally:
+            wall = time.time() - start
+            responses = _RESPONSE_LOG.responses
+            _RESPONSE_LOG.responses = None
+        server_times = [t for t in map(_server_time, responses)
+                        if t is not None]
+        server = sum(server_times) if server_times else None
+        return wall, server, error
+
+    def do_time(self, arglist):
+        """
+        Run a command and print how long it took
+
+        ``time version`` runs ``version`` and prints the wall time and the
+        time the server spent handling it
+
+        """
+        if not arglist.strip():
+            raise TypeError("Must provide a command to run")
+        wall, server, error = self._timed_cmd(arglist)
+        if error is not None:
+            print colors.red("%s: %s" % (type(error).__name__, error))
+        server_str = 'unknown' if server is None else \
+            '%.1fms' % (1000 * server)
+        print "wall: %.1fms  server: %s" % (1000 * wall, server_str)
+
+    def do_bench(self, arglist):
+        """
+        Run a command many times and print latency statistics
+
+        ``bench 100 version`` runs ``version`` 100 times
+
+        ``bench 1000 concurrency=10 /check_auth`` runs ``/check_auth`` 1000
+        times, with 10 running at once
+
+        """
+        parts = arglist.split(None, 1)
+        if len(parts) < 2 or not parts[0].isdigit():
+            raise TypeError("Usage: bench N [concurrency=C] <command>")
+        count, line = int(parts[0]), parts[1]
+        concurrency = 1
+        if line.startswith('concurrency='):
+            option, line = (line.split(None, 1) + [''])[:2]
+            concurrency = int(option.split('=', 1)[1])
+        if not line.strip():
+            raise TypeError("Must provide a command to run")
+
+        # Log in now, since the workers can't prompt for a password. If the
+        # ticket expires during the run, the commands fail instead.
+        if self._needs_auth():
+            self._login()
+        reauth, self.reauth = self.reauth, None
+
+        # Don't print the output of the command every time
+        stdout = sys.stdout = _QuietStdout(sys.stdout)
+
+        def run(_):
+            """ Run the command without printing its output """
+            stdout.quiet = True
             try:
-                data = response.json()
-            except:
-                data = None
-            kw = {}
-            if data is not None:
-                kw['detail'] = data['detail']
-            raise exception_response(response.status_code, **kw)
-        if response.cookies:
-            self.cookies.update(response.cookies)
-        return response
+                return self._timed_cmd(line)
+            finally:
+                stdout.quiet = False
+
+        pool = ThreadPool(concurrency)
+        try:
+            start = time.time()
+            results = pool.map(run, xrange(count))
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            self.reauth = reauth
+            sys.stdout = stdout.stream
+            stdout.close()
+
+        latencies = sorted(wall for wall, _, _ in results)
+        server_times = sorted(server for _, server, _ in results
+                              if server is not None)
+        errors = {}
+        for _, _, error in results:
+            if error is not None:
+                name = type(error).__name__
+                errors[name] = errors.get(name, 0) + 1
+        print "%d runs in %.2fs (%.1f/s), concurrency %d" % (
+            count, elapsed, count / elapsed, concurrency)
+        for name, values in (('latency', latencies), ('server', server_times)):
+            if values:
+                print "%-8s p50 %.1fms  p95 %.1fms  p99 %.1fms" % (
+                    name + ':', 1000 * percentile(values, 50),
+                    1000 * percentile(values, 95),
+                    1000 * percentile(values, 99))
+        if errors:
+            print colors.red("errors: %d (%s)" % (
+                sum(errors.values()),
+                ', '.join('%s: %d' % item for item in sorted(errors.items()))))
+        else:
+            print "errors: 0"
+
+    @repl_command
+    def do_subscribe(self, *topics):
+        """
+        Print events published on the server as they arrive
+
+        ``subscribe`` will print all events
+
+        ``subscribe deploy.*`` will print events whose topic starts with
+        'deploy.'
+
+        Press Ctrl-C to stop.
+
+        """
+        try:
+            for topic, data in self.subscribe(topics):
+                print colors.cyan(topic)
+                pprint(data)
+        except KeyboardInterrupt:
+            print
 
     @repl_command
     def default(self, *args, **kwargs):
@@ -328,11 +1523,11 @@ class StewardREPL(Cmd):
         If there is an unrecognized command, send it to the server and see what
         happens!
         """
-        response = self.cmd(*args, **kwargs)
         try:
-            pprint(response.json())
-        except:
-            print response.text
+            for item in self.cmd_stream(*args, **kwargs):
+                pprint(item)
+        except ValueError:
+            print self._last_response.text
 
     @repl_command
     def do_EOF(self):  # pylint: disable=C0103
@@ -350,15 +1545,57 @@ class StewardREPL(Cmd):
         pass
 
 
+def load_conf(path):
+    """
+    Load the client configuration
+
+    Parameters
+    ----------
+    path : str
+        Path to a yaml config file, or to a directory of yaml config files
+        that will be merged together
+
+    Returns
+    -------
+    conf : dict
+
+    """
+    import yaml
+    # The C loader is much faster, but is only present if libyaml is installed
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    if os.path.isfile(path):
+        with open(path, 'r') as infile:
+            return yaml.load(infile, Loader=loader)
+    conf = {}
+    for filename in os.listdir(path):
+        if filename.endswith('.yaml'):
+            with open(os.path.join(path, filename), 'r') as infile:
+                conf.update(yaml.load(infile, Loader=loader))
+    return conf
+
+
 def run_client():
     """ Entry point for running the REPL """
     import argparse
-    import sys
-    import yaml
 
     parser = argparse.ArgumentParser(description=run_client.__doc__)
     parser.add_argument('-c', default='/etc/steward/client',
                         help="Config file or directory (default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Print how long each step of startup takes")
+    parser.add_argument('-f', '--file', metavar='SCRIPT',
+                        help="Run the commands in this file ('-' for stdin) "
+                        "concurrently and print one JSON line per result")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of commands to run at once in script "
+                        "mode (default 'concurrency' from the config or 10)")
+    parser.add_argument('--ordered', action='store_true',
+                        help="Print script results in the order of the "
+                        "commands instead of as they finish")
+    parser.add_argument('--fail-fast', action='store_true',
+                        help="Stop running the script after the first error")
+    parser.add_argument('-u', '--user',
+                        help="Username to log in with in script mode")
     parser.add_argument('cmd', nargs='*',
                         help="Run this command, print the output, and exit")
 
@@ -368,19 +1605,42 @@ def run_client():
                "/etc/steward/client/ not found")
         sys.exit(1)
 
+    start = time.time()
+    conf = load_conf(args['c'])
+    if args['verbose']:
+        print >> sys.stderr, "startup: %-10s %8.1fms" % (
+            'conf', 1000 * (time.time() - start))
+    if args['file'] is not None:
+        sys.exit(_run_script_mode(parser, conf, args))
     cli = StewardREPL()
-    if os.path.isfile(args['c']):
-        with open(args['c'], 'r') as infile:
-            conf = yaml.safe_load(infile)
-    else:
-        conf = {}
-        for filename in os.listdir(args['c']):
-            if filename.endswith('.yaml'):
-                with open(os.path.join(args['c'], filename), 'r') as infile:
-                    conf.update(yaml.safe_load(infile))
-
+    cli.verbose = args['verbose']
     cli.initialize(conf)
     if args['cmd']:
         cli.onecmd(' '.join(args['cmd']))
     else:
         cli.start()
+
+
+def _run_script_mode(parser, conf, args):
+    """ Run a script of commands for ``run_client`` and return the exit code """
+    from steward.parallel import ParallelClient, run_script
+    with ParallelClient(conf, concurrency=args['jobs']) as client:
+        if args['file'] == '-':
+            # Can't prompt for a username when the script is on stdin
+            if args['user'] is None and client._needs_auth():
+                parser.error("Not logged in. Pass --user to log in.")
+            lines = iter(sys.stdin.readline, '')
+        else:
+            lines = open(args['file'], 'r')
+        client.login(args['user'])
+        if args['file'] == '-' and args['user'] is None:
+            # Prompting for a username would read the script's lines, so
+            # commands fail with a 403 if the ticket expires instead
+            client.reauth = None
+        try:
+            errors = run_script(client, lines, ordered=args['ordered'],
+                                fail_fast=args['fail_fast'])
+        finally:
+            if hasattr(lines, 'close'):
+                lines.close()
+    return 1 if errors else 0
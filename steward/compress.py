@@ -0,0 +1,94 @@
+""" Gzip compression of requests and responses """
+import logging
+import zlib
+from pyramid.httpexceptions import HTTPBadRequest, HTTPRequestEntityTooLarge
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW
+
+
+LOG = logging.getLogger(__name__)
+
+# Tell zlib to read and write gzip headers
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _decompress_request(request, max_size):
+    """ Replace a gzipped request body with the decompressed body """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    compressed = request.body
+    try:
+        body = decompressor.decompress(compressed, max_size)
+    except zlib.error:
+        raise HTTPBadRequest("Invalid gzip request body")
+    if decompressor.unconsumed_tail:
+        raise HTTPRequestEntityTooLarge("Request body is too large")
+    del request.headers['Content-Encoding']
+    request.body = body
+    LOG.debug("Decompressed request body %d -> %d bytes", len(compressed),
+              len(body))
+
+
+def _iter_compressed(app_iter, level):
+    """ Gzip a streaming response, flushing after every chunk """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    try:
+        for chunk in app_iter:
+            yield compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def _compress_response(response, min_size, level):
+    """ Gzip the response body if it is worth compressing """
+    if response.content_encoding or response.status_int in (204, 304):
+        return
+    response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+    if response.content_length is None:
+        response.app_iter = _iter_compressed(response.app_iter, level)
+    else:
+        if response.content_length < min_size:
+            return
+        body = response.body
+        compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        response.body = compressor.compress(body) + compressor.flush()
+        LOG.debug("Compressed response %d -> %d bytes", len(body),
+                  response.content_length)
+    response.content_encoding = 'gzip'
+
+
+def compress_tween_factory(handler, registry):
+    """
+    Tween that gzips responses and decompresses gzipped request bodies
+
+    Responses are only compressed if the client sends ``Accept-Encoding:
+    gzip`` and the body is at least ``steward.compress.min_size`` bytes.
+    Streaming responses are always compressed.
+
+    """
+    settings = registry.settings
+    min_size = int(settings.get('steward.compress.min_size', 1024))
+    level = int(settings.get('steward.compress.level', 6))
+    max_request_size = int(settings.get('steward.compress.max_request_size',
+                                        10 * 1024 * 1024))
+
+    def compress_tween(request):
+        """ Compress the response """
+        if request.headers.get('Content-Encoding') == 'gzip':
+            _decompress_request(request, max_request_size)
+        response = handler(request)
+        if 'gzip' in request.headers.get('Accept-Encoding', '') and \
+                request.method != 'HEAD':
+            _compress_response(response, min_size, level)
+        return response
+    return compress_tween
+
+
+def includeme(config):
+    """ Configure the app """
+    settings = config.get_settings()
+    if asbool(settings.get('steward.compress', False)):
+        config.add_tween('steward.compress.compress_tween_factory',
+                         over=EXCVIEW)
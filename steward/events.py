@@ -0,0 +1,216 @@
+""" In-process pub/sub for pushing server events to clients """
+import fnmatch
+import logging
+import threading
+import time
+from Queue import Queue, Full, Empty
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.response import Response
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Subscription(object):
+
+    """
+    A subscriber's bounded queue of events
+
+    If the subscriber falls behind and the queue fills up, the oldest events
+    are dropped so that publishers never block.
+
+    Parameters
+    ----------
+    topics : list
+        List of topic patterns (fnmatch-style, e.g. ``'deploy.*'``). If empty,
+        subscribe to all topics.
+    max_size : int
+        The maximum number of queued events
+
+    Attributes
+    ----------
+    dropped : int
+        The number of events that were dropped because the queue was full
+
+    """
+    def __init__(self, topics, max_size):
+        self.topics = list(topics or ())
+        self.queue = Queue(max_size)
+        self.dropped = 0
+
+    def matches(self, topic):
+        """ Check if this subscription wants events of a topic """
+        if not self.topics:
+            return True
+        for pattern in self.topics:
+            if fnmatch.fnmatchcase(topic, pattern):
+                return True
+        return False
+
+    def put(self, event):
+        """ Enqueue an event without blocking """
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Get the next ``(topic, payload)`` event
+
+        Returns None if no event arrives before the timeout.
+
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class EventBroker(object):
+
+    """
+    Fans out published events to all matching subscriptions
+
+    Parameters
+    ----------
+    encode : callable
+        Function that serializes event data to a string. It is called once per
+        event, no matter how many subscribers there are.
+    queue_size : int, optional
+        The size of each subscriber's queue (default 100)
+    max_subscribers : int, optional
+        The maximum number of subscriptions at one time. If None, there is no
+        limit. (default None)
+
+    """
+    def __init__(self, encode, queue_size=100, max_subscribers=None):
+        self.encode = encode
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics=None):
+        """
+        Create a new :class:`~.Subscription`
+
+        Returns None if there are already ``max_subscribers`` subscriptions.
+
+        """
+        sub = Subscription(topics, self.queue_size)
+        with self._lock:
+            if self.max_subscribers is not None and \
+                    len(self._subscriptions) >= self.max_subscribers:
+                return None
+            self._subscriptions.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """ Remove a :class:`~.Subscription` """
+        with self._lock:
+            self._subscriptions.discard(sub)
+
+    def publish(self, topic, data=None):
+        """
+        Publish an event
+
+        Parameters
+        ----------
+        topic : str
+            The name of the event
+        data : object, optional
+            JSON-serializable payload for the event
+
+        Returns
+        -------
+        count : int
+            The number of subscribers the event was delivered to
+
+        """
+        with self._lock:
+            subs = [sub for sub in self._subscriptions if sub.matches(topic)]
+        if not subs:
+            return 0
+        event = (topic, self.encode(data))
+        for sub in subs:
+            sub.put(event)
+        return len(subs)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+def _publish(request, topic, data=None):
+    """ Publish an event to all subscribers (see :class:`~.EventBroker`) """
+    return request.registry.event_broker.publish(topic, data)
+
+
+def _stream_events(broker, sub, heartbeat, max_duration):
+    """ Generate a text/event-stream body for a subscription """
+    deadline = time.time() + max_duration
+    try:
+        # Send something immediately so the client knows it's connected
+        yield ': connected\n\n'
+        while time.time() < deadline:
+            event = sub.get(min(heartbeat, max(0, deadline - time.time())))
+            if event is None:
+                yield ': heartbeat\n\n'
+                continue
+            topic, payload = event
+            yield 'event: %s\ndata: %s\n\n' % (topic, payload)
+    finally:
+        broker.unsubscribe(sub)
+        if sub.dropped:
+            LOG.warning("Subscriber dropped %d events", sub.dropped)
+
+
+def do_events(request):
+    """
+    Stream events to the client as server-sent events
+
+    Each subscriber holds a server thread for as long as it is connected, so
+    this requires a threaded server. Once ``steward.events.max_subscribers``
+    clients are connected, new subscribers get a 503. Connections are closed
+    after ``steward.events.max_duration`` seconds, and the client reconnects.
+
+    Parameters
+    ----------
+    topics : list, optional
+        List of topic patterns to subscribe to (default all)
+
+    """
+    topics = request.param('topics', [], type=list)
+    settings = request.registry.settings
+    heartbeat = float(settings.get('steward.events.heartbeat', 15))
+    max_duration = float(settings.get('steward.events.max_duration', 300))
+    broker = request.registry.event_broker
+    sub = broker.subscribe(topics)
+    if sub is None:
+        # A slot frees up when the oldest subscriber hits max_duration
+        headers = {'Retry-After': '%d' % max_duration}
+        raise HTTPServiceUnavailable("Too many subscribers", headers=headers)
+    response = Response(content_type='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.app_iter = _stream_events(broker, sub, heartbeat, max_duration)
+    return response
+
+
+def includeme(config):
+    """ Configure the app """
+    from steward import json_renderer
+    settings = config.get_settings()
+    render = json_renderer(None)
+    config.registry.event_broker = EventBroker(
+        lambda data: render(data, {}),
+        int(settings.get('steward.events.queue_size', 100)),
+        int(settings.get('steward.events.max_subscribers', 10)))
+    config.add_request_method(_publish, name='publish')
+    config.add_route('events', '/events')
+    config.add_view('steward.events.do_events', route_name='events')
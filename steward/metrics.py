@@ -0,0 +1,266 @@
+""" Request metrics in the Prometheus text format """
+import bisect
+import threading
+import time
+from pyramid.events import ContextFound
+from pyramid.response import Response
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram(object):
+
+    """
+    Cumulative histogram of observed values
+
+    Parameters
+    ----------
+    buckets : tuple
+        The sorted upper bounds of the buckets
+
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Record a value """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """ Render the histogram as lines of the Prometheus text format """
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' %
+                         (name, labels, bound, total))
+        lines.append('%s_sum{%s} %f' % (name, labels.rstrip(','), self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','),
+                                          self.count))
+        return lines
+
+
+def _label(value):
+    """ Escape a label value """
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"')
+
+
+class Metrics(object):
+
+    """
+    Collects per-route request, subrequest, and auth timings
+
+    All methods are thread-safe.
+
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.requests = {}
+        self.latency = {}
+        self.in_flight = {}
+        self.subrequests = {}
+        self.auth = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _observe(self, histograms, key, duration):
+        """ Add a value to the histogram for a key """
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        histogram.observe(duration)
+
+    def start_request(self, route):
+        """ Mark a request for a route as in flight """
+        with self._lock:
+            self.in_flight[route] = self.in_flight.get(route, 0) + 1
+
+    def finish_request(self, route, status, duration, started=True):
+        """ Record a finished request """
+        with self._lock:
+            if started:
+                self.in_flight[route] -= 1
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._observe(self.latency, route, duration)
+
+    def observe_subrequest(self, route, duration):
+        """ Record a finished subrequest """
+        with self._lock:
+            self._observe(self.subrequests, route, duration)
+
+    def observe_auth(self, method, duration):
+        """ Record a call to the auth db """
+        with self._lock:
+            self._observe(self.auth, method, duration)
+
+    def add_collector(self, collector):
+        """
+        Add a function that produces extra metrics
+
+        Parameters
+        ----------
+        collector : callable
+            Function that takes no arguments and returns a list of
+            ``(name, type, labels, value)`` tuples, where ``labels`` is a
+            dict.
+
+        """
+        self.collectors.append(collector)
+
+    def _render_histograms(self, lines, name, label, histograms, doc):
+        """ Render a dict of histograms """
+        lines.append('# HELP %s %s' % (name, doc))
+        lines.append('# TYPE %s histogram' % name)
+        for key, histogram in sorted(histograms.items()):
+            lines.extend(histogram.render(name,
+                                          '%s="%s",' % (label, _label(key))))
+
+    def render(self):
+        """ Render all metrics in the Prometheus text format """
+        lines = []
+        with self._lock:
+            lines.append('# HELP steward_requests_total Requests by route '
+                         'and status code')
+            lines.append('# TYPE steward_requests_total counter')
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append('steward_requests_total{route="%s",status="%s"} '
+                             '%d' % (_label(route), status, count))
+            lines.append('# HELP steward_requests_in_flight Requests '
+                         'currently being handled')
+            lines.append('# TYPE steward_requests_in_flight gauge')
+            for route, count in sorted(self.in_flight.items()):
+                lines.append('steward_requests_in_flight{route="%s"} %d' %
+                             (_label(route), count))
+            self._render_histograms(
+                lines, 'steward_request_duration_seconds', 'route',
+                self.latency, 'Request latency by route')
+            self._render_histograms(
+                lines, 'steward_subrequest_duration_seconds', 'route',
+                self.subrequests, 'Subrequest latency by route')
+            self._render_histograms(
+                lines, 'steward_auth_duration_seconds', 'method', self.auth,
+                'Time spent in the auth db')
+        extra = []
+        for collector in self.collectors:
+            extra.extend(collector())
+        # All samples of a metric must be grouped together
+        extra.sort(key=lambda metric: metric[0])
+        seen = set()
+        for name, metric_type, labels, value in extra:
+            if name not in seen:
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                seen.add(name)
+            label_str = ','.join('%s="%s"' % (key, _label(val)) for
+                                 key, val in sorted(labels.items()))
+            lines.append('%s{%s} %s' % (name, label_str, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _route_name(request):
+    """ Get the name of the route that matched a request """
+    route = getattr(request, 'matched_route', None)
+    return route.name if route is not None else '<none>'
+
+
+def _on_context_found(event):
+    """ Mark the request as in flight once we know its route """
+    request = event.request
+    # Subrequests have their own environ and are not timed by the tween
+    if request.environ.get('steward.metrics.active'):
+        route = _route_name(request)
+        request.environ['steward.metrics.route'] = route
+        request.registry.metrics.start_request(route)
+
+
+def metrics_tween_factory(handler, registry):
+    """
+    Tween that records the latency and status code of every request
+
+    The time spent handling the request is also sent to the client in a
+    ``Server-Timing`` header.
+
+    """
+    metrics = registry.metrics
+
+    def metrics_tween(request):
+        """ Time the request """
+        start = time.time()
+        status = 500
+        request.environ['steward.metrics.active'] = True
+        try:
+            response = handler(request)
+            status = response.status_int
+            response.headers['Server-Timing'] = 'total;dur=%.3f' % \
+                (1000 * (time.time() - start))
+            return response
+        except Exception as e:
+            # Exceptions raised above the exception view tween (such as a bad
+            # gzip body) are rendered later. HTTP exceptions keep their code.
+            status = getattr(e, 'status_int', 500)
+            raise
+        finally:
+            route = request.environ.get('steward.metrics.route')
+            metrics.finish_request(route or _route_name(request), status,
+                                   time.time() - start, route is not None)
+    return metrics_tween
+
+
+def _cache_metrics(registry):
+    """ Collect hit/miss counts of the auth and view caches """
+    metrics = []
+    caches = {}
+    # Auth db wrappers expose the attributes of the auth db they wrap
+    auth_db = getattr(registry, 'auth_db', None)
+    if hasattr(auth_db, 'cache'):
+        caches['login'] = auth_db.cache
+    if hasattr(auth_db, 'reload_stats'):
+        stats = auth_db.reload_stats()
+        metrics.append(('steward_auth_db_reloads_total', 'counter', {},
+                        stats['reloads']))
+        metrics.append(('steward_auth_db_reload_errors_total', 'counter',
+                        {}, stats['errors']))
+    callback = getattr(registry, 'groups_callback', None)
+    if callback is not None and callback.cache is not None:
+        caches['groups'] = callback.cache
+    view_cache = getattr(registry, 'view_cache', None)
+    if view_cache is not None:
+        caches['view'] = view_cache
+    for name, cache in caches.items():
+        metrics.append(('steward_cache_hits_total', 'counter',
+                        {'cache': name}, cache.hits))
+        metrics.append(('steward_cache_misses_total', 'counter',
+                        {'cache': name}, cache.misses))
+    return metrics
+
+
+def do_metrics(request):
+    """ Get all metrics in the Prometheus text format """
+    return Response(request.registry.metrics.render(),
+                    content_type='text/plain; version=0.0.4')
+
+
+def includeme(config):
+    """ Configure the app """
+    settings = config.get_settings()
+    if not asbool(settings.get('steward.metrics', True)):
+        config.registry.metrics = None
+        return
+    metrics = config.registry.metrics = Metrics()
+    registry = config.registry
+    metrics.add_collector(lambda: _cache_metrics(registry))
+    config.add_subscriber(_on_context_found, ContextFound)
+    config.add_tween('steward.metrics.metrics_tween_factory', under=INGRESS)
+    config.add_route('metrics', '/metrics')
+    config.add_view('steward.metrics.do_metrics', route_name='metrics',
+                    permission=NO_PERMISSION_REQUIRED)
@@ -0,0 +1,309 @@
+""" Client for running many steward commands concurrently """
+import getpass
+import json
+import sys
+import time
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Event, Thread
+
+from steward.client import (StewardClient, DEFAULT_INCLUDES, load_conf,
+                            parse_args)
+
+
+class ParallelClient(StewardClient):
+
+    """
+    Client that runs commands on a bounded pool of worker threads
+
+    All workers share one pooled session, so the auth cookies and the
+    connections to the server are reused across requests.
+
+    Parameters
+    ----------
+    conf : dict
+        Configuration dictionary. This is the same format that the
+        ``steward`` command reads (see :func:`~steward.client.load_conf`).
+    concurrency : int, optional
+        The maximum number of requests in flight at once (default
+        ``conf['concurrency']`` or 10)
+    max_pending : int, optional
+        The maximum number of requests that may be queued or running. Once
+        this is reached, :meth:`submit` blocks until a request finishes
+        (default 10 * concurrency)
+
+    Attributes
+    ----------
+    commands : dict
+        Mapping of command names to the functions registered by extensions
+        with :meth:`set_cmd`
+
+    Examples
+    --------
+    ::
+
+        with ParallelClient(load_conf('client.yaml'), concurrency=20) as cli:
+            cli.login()
+            results = cli.map([('/version', {})] * 500)
+
+    """
+    def __init__(self, conf, concurrency=None, max_pending=None):
+        conf = dict(conf)
+        self.concurrency = concurrency or conf.get('concurrency', 10)
+        conf.setdefault('pool_maxsize', self.concurrency)
+        self.configure(conf)
+        self.commands = {}
+        self._workers = ThreadPool(self.concurrency)
+        self._pending = BoundedSemaphore(max_pending or 10 * self.concurrency)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """ Construct a client from a config file or directory """
+        return cls(load_conf(path), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """ Wait for all pending requests and shut down the workers """
+        self._workers.close()
+        self._workers.join()
+
+    def login(self, userid=None, password=None):
+        """
+        Authenticate with the server if the saved cookies are not valid
+
+        Prompts for any credentials that are not provided. If the auth ticket
+        expires later, the client will log in again the same way.
+
+        """
+        def authenticate():
+            """ Log in, prompting for missing credentials """
+            user = userid if userid is not None else raw_input('Username: ')
+            pword = password if password is not None else getpass.getpass()
+            self._auth(user, pword)
+        self.reauth = authenticate
+        if self._needs_auth():
+            authenticate()
+
+    def load_extensions(self, mods=None):
+        """
+        Register the commands of client extensions
+
+        Parameters
+        ----------
+        mods : list, optional
+            List of modules or dotted module paths (default is the
+            ``includes`` from the config)
+
+        """
+        if mods is None:
+            mods = DEFAULT_INCLUDES + self.conf.get('includes', [])
+        for mod in mods:
+            self.name_resolver.maybe_resolve(mod).include_client(self)
+
+    def set_cmd(self, name, function, wrap=True):
+        """ Register an extension command that can be run with :meth:`run` """
+        self.commands[name] = self.name_resolver.maybe_resolve(function)
+
+    def set_autocomplete(self, command, args):
+        """ No-op so that extensions written for the REPL can be loaded """
+
+    def _call(self, function, args, kwargs):
+        """ Run a function on a worker and release its pending slot """
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._pending.release()
+
+    def submit_call(self, function, *args, **kwargs):
+        """
+        Run a function on the worker pool
+
+        Blocks if there are already ``max_pending`` outstanding calls.
+
+        Returns
+        -------
+        result : :class:`multiprocessing.pool.AsyncResult`
+
+        """
+        self._pending.acquire()
+        try:
+            return self._workers.apply_async(self._call,
+                                             (function, args, kwargs))
+        except:
+            self._pending.release()
+            raise
+
+    def submit(self, uri, **kwargs):
+        """
+        Run :meth:`~steward.client.StewardClient.cmd` on the worker pool
+
+        Returns
+        -------
+        result : :class:`multiprocessing.pool.AsyncResult`
+            ``result.get()`` returns the :class:`requests.Response`
+
+        """
+        return self.submit_call(self.cmd, uri, **kwargs)
+
+    def run(self, name, *args, **kwargs):
+        """ Run an extension command on the worker pool """
+        return self.submit_call(self.commands[name], self, *args, **kwargs)
+
+    def map(self, calls, timeout=None, return_exceptions=False):
+        """
+        Run many commands concurrently and wait for all of them
+
+        Parameters
+        ----------
+        calls : list
+            Iterable of ``(uri, kwargs)`` tuples
+        timeout : float, optional
+            Maximum number of seconds to wait for each result
+        return_exceptions : bool, optional
+            If True, errors are returned in place of the results instead of
+            being raised (default False)
+
+        Returns
+        -------
+        responses : list
+            The :class:`requests.Response` (or exception) of each call, in
+            order
+
+        """
+        pending = [self.submit(uri, **(kwargs or {})) for uri, kwargs in calls]
+        results = []
+        for result in pending:
+            try:
+                results.append(result.get(timeout))
+            except Exception as e:  # pylint: disable=W0703
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+
+def _expand_alias(line, aliases):
+    """ Replace a leading alias in a command line with its target """
+    parts = line.split(None, 1)
+    if parts and parts[0] in aliases:
+        return ' '.join([aliases[parts[0]]] + parts[1:])
+    return line
+
+
+def _run_line(client, lineno, line, aliases):
+    """ Run one script command and build its result record """
+    record = {'line': lineno, 'command': line}
+    start = time.time()
+    try:
+        args, kwargs = parse_args(_expand_alias(line, aliases))
+        if len(args) != 1:
+            raise ValueError("Commands must be '<uri> [key=value ...]'")
+        response = client.cmd(args[0], **kwargs)
+        record['status'] = response.status_code
+        try:
+            record['result'] = response.json()
+        except ValueError:
+            record['result'] = response.text
+    except Exception as e:  # pylint: disable=W0703
+        record['status'] = getattr(e, 'code', None)
+        record['error'] = getattr(e, 'detail', None) or str(e) or \
+            type(e).__name__
+    record['time'] = time.time() - start
+    return record
+
+
+def run_script(client, lines, ordered=False, fail_fast=False, out=None):
+    """
+    Run many commands concurrently and write one JSON line per result
+
+    Each command is a server command in the same format as the REPL
+    (``<uri> [key=value ...]``) or an alias from the client config. Blank
+    lines and lines starting with '#' are skipped. Each result is a JSON
+    object with the ``line`` number, ``command``, ``status`` code, ``time``
+    (in seconds), and either the ``result`` or the ``error``.
+
+    Parameters
+    ----------
+    client : :class:`~.ParallelClient`
+    lines : iterable
+        The commands. They are read lazily, so this may be a file or stdin.
+    ordered : bool, optional
+        Write the results in the same order as the commands. By default they
+        are written as soon as they finish. (default False)
+    fail_fast : bool, optional
+        Stop running commands after the first error (default False)
+    out : file, optional
+        Where to write the results (default stdout)
+
+    Returns
+    -------
+    errors : int
+        The number of commands that failed
+
+    """
+    out = out or sys.stdout
+    aliases = client.conf.get('aliases', {})
+    results = Queue()
+    stop = Event()
+
+    def run(index, lineno, line):
+        """ Run a command unless the script was stopped """
+        record = None
+        if not stop.is_set():
+            record = _run_line(client, lineno, line, aliases)
+        results.put((index, record))
+
+    def feed():
+        """ Submit all of the commands, then the total count """
+        count = 0
+        try:
+            for lineno, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if stop.is_set():
+                    break
+                client.submit_call(run, count, lineno, line)
+                count += 1
+        finally:
+            results.put((None, count))
+
+    feeder = Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    errors = 0
+    received = 0
+    total = None
+    buffered = {}
+    next_index = 0
+    while total is None or received < total:
+        index, record = results.get()
+        if index is None:
+            total = record
+            continue
+        received += 1
+        if ordered:
+            buffered[index] = record
+            ready = []
+            while next_index in buffered:
+                ready.append(buffered.pop(next_index))
+                next_index += 1
+        else:
+            ready = [record]
+        for record in ready:
+            if record is None or stop.is_set():
+                continue
+            out.write(json.dumps(record) + '\n')
+            if 'error' in record:
+                errors += 1
+                if fail_fast:
+                    stop.set()
+        out.flush()
+    feeder.join()
+    return errors
@@ -0,0 +1,181 @@
+""" On-demand profiling of individual requests """
+import os
+
+import cProfile
+import glob
+import heapq
+import logging
+import tempfile
+import threading
+import time
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW
+from uuid import uuid1
+
+from steward.auth import Root
+
+
+LOG = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Steward-Profile'
+
+
+class SlowRequests(object):
+
+    """
+    Keeps the N slowest requests seen in a rolling time window
+
+    Parameters
+    ----------
+    size : int
+        The number of requests to keep
+    window : float
+        Requests older than this many seconds are forgotten
+
+    """
+    def __init__(self, size=20, window=3600):
+        self.size = size
+        self.window = window
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, duration, entry):
+        """ Record a request if it is one of the slowest """
+        now = time.time()
+        cutoff = now - self.window
+        with self._lock:
+            if self._heap and min(item[1] for item in self._heap) < cutoff:
+                self._heap = [item for item in self._heap
+                              if item[1] >= cutoff]
+                heapq.heapify(self._heap)
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, (duration, now, entry))
+            elif duration > self._heap[0][0]:
+                heapq.heapreplace(self._heap, (duration, now, entry))
+
+    def slowest(self):
+        """ Get the slowest requests in the window, slowest first """
+        cutoff = time.time() - self.window
+        with self._lock:
+            entries = [dict(entry, duration=duration, time=timestamp) for
+                       duration, timestamp, entry in self._heap
+                       if timestamp >= cutoff]
+        return sorted(entries, key=lambda entry: -entry['duration'])
+
+    def clear(self):
+        """ Forget all recorded requests """
+        with self._lock:
+            self._heap = []
+
+
+def _wants_profile(request):
+    """ Check if a request asked to be profiled and is allowed to be """
+    if not (request.headers.get(PROFILE_HEADER) or
+            request.GET.get('_profile')):
+        return False
+    return bool(request.has_permission('profile', Root(request)))
+
+
+def _prune_profiles(directory, max_files):
+    """ Delete the oldest profiles so that at most ``max_files`` remain """
+    filenames = glob.glob(os.path.join(directory, '*.prof'))
+    if len(filenames) <= max_files:
+        return
+    filenames.sort(key=os.path.getmtime)
+    for filename in filenames[:len(filenames) - max_files]:
+        try:
+            os.remove(filename)
+        except OSError:
+            # Another thread may have already removed it
+            pass
+
+
+def profile_tween_factory(handler, registry):
+    """
+    Tween that profiles requests with cProfile on demand
+
+    A request is profiled if it has an ``X-Steward-Profile`` header or a
+    ``_profile`` query parameter, and the user has the 'profile' permission
+    (admins have it by default). Since anyone has every permission when auth
+    is disabled, requests are only profiled if ``steward.auth.enable`` is
+    true. The profile is written in pstats format to ``steward.profile.dir``,
+    which keeps the newest ``steward.profile.max_files`` profiles.
+
+    The duration of every request is also recorded so that the slowest ones
+    can be retrieved from ``/profile``.
+
+    """
+    settings = registry.settings
+    directory = settings.get('steward.profile.dir',
+                             os.path.join(tempfile.gettempdir(),
+                                          'steward-profiles'))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    max_files = int(settings.get('steward.profile.max_files', 100))
+    slow_requests = registry.slow_requests
+    allow_profile = registry.queryUtility(IAuthenticationPolicy) is not None
+    if not allow_profile:
+        LOG.warning("Request profiling requires steward.auth.enable")
+
+    def profile_tween(request):
+        """ Profile the request if requested """
+        start = time.time()
+        filename = None
+        if allow_profile and _wants_profile(request):
+            profiler = cProfile.Profile()
+            try:
+                response = profiler.runcall(handler, request)
+            finally:
+                filename = os.path.join(directory, '%d-%s.prof' %
+                                        (start, uuid1().hex))
+                profiler.dump_stats(filename)
+                LOG.info("Wrote profile of %s to %s", request.path, filename)
+                _prune_profiles(directory, max_files)
+            response.headers[PROFILE_HEADER] = os.path.basename(filename)
+        else:
+            response = handler(request)
+        route = getattr(request, 'matched_route', None)
+        slow_requests.add(time.time() - start, {
+            'route': route.name if route is not None else None,
+            'path': request.path,
+            'status': response.status_int,
+            'profile': filename,
+        })
+        return response
+    return profile_tween
+
+
+def do_profile(request):
+    """
+    Get the slowest recent requests
+
+    Parameters
+    ----------
+    reset : bool, optional
+        If true, clear the list after returning it (default False)
+
+    """
+    slowest = request.registry.slow_requests.slowest()
+    for entry in slowest:
+        if entry['profile'] is not None and \
+                not os.path.exists(entry['profile']):
+            # The profile was pruned
+            entry['profile'] = None
+    if request.param('reset', False, type=bool):
+        request.registry.slow_requests.clear()
+    return slowest
+
+
+def includeme(config):
+    """ Configure the app """
+    settings = config.get_settings()
+    if not asbool(settings.get('steward.profile', False)):
+        return
+    config.registry.slow_requests = SlowRequests(
+        int(settings.get('steward.profile.top', 20)),
+        float(settings.get('steward.profile.window', 3600)))
+    config.add_tween('steward.profile.profile_tween_factory', over=EXCVIEW)
+    config.add_route('profile', '/profile')
+    config.add_view('steward.profile.do_profile', route_name='profile',
+                    renderer='json', permission='profile')
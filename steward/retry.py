@@ -0,0 +1,137 @@
+""" Retry policies and circuit breakers for the client """
+import fnmatch
+import random
+import requests
+import threading
+import time
+
+
+# Server errors that are worth retrying
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.ConnectionError):
+
+    """ Raised instead of sending a request to a host that keeps failing """
+
+
+class RetryPolicy(object):
+
+    """
+    Decides which commands are retried and how long to wait in between
+
+    Parameters
+    ----------
+    retries : int, optional
+        Maximum number of times to retry a command (default 0)
+    backoff : float, optional
+        The base delay in seconds. The nth retry waits a random amount of time
+        between 0 and ``backoff * 2 ** (n - 1)``. (default 0.1)
+    max_backoff : float, optional
+        The maximum delay in seconds (default 5)
+    idempotent : list, optional
+        List of uri patterns (fnmatch-style, e.g. ``'/pkg/*'``) of the
+        commands that are safe to send more than once. Only these are retried
+        or hedged.
+
+    """
+    def __init__(self, retries=0, backoff=0.1, max_backoff=5,
+                 idempotent=()):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idempotent = list(idempotent)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """ Create a policy from the client config """
+        return cls(conf.get('retries', 0), conf.get('retry_backoff', 0.1),
+                   conf.get('retry_max_backoff', 5),
+                   conf.get('idempotent_commands', ()))
+
+    def is_idempotent(self, uri):
+        """ Check if a command may be sent more than once """
+        for pattern in self.idempotent:
+            if fnmatch.fnmatchcase(uri, pattern):
+                return True
+        return False
+
+    def delay(self, attempt):
+        """ Get the number of seconds to wait before a retry """
+        limit = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, limit)
+
+
+class CircuitBreaker(object):
+
+    """
+    Stops sending requests to a host after repeated failures
+
+    After ``threshold`` consecutive failures the circuit opens and requests
+    fail immediately. Once ``reset_timeout`` seconds have passed, a single
+    trial request is let through. If it succeeds the circuit closes,
+    otherwise it opens again.
+
+    Parameters
+    ----------
+    threshold : int, optional
+        Number of consecutive failures that open the circuit (default 5)
+    reset_timeout : float, optional
+        Seconds to wait before letting a trial request through (default 30)
+
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ 'closed', 'open', or 'half-open' """
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """ Check if a request may be sent """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout or \
+                    self._trial is not None:
+                return False
+            # The trial belongs to this thread until it records a result
+            self._trial = threading.current_thread().ident
+            return True
+
+    def cancel_trial(self):
+        """
+        Give up the trial request of this thread without recording a result
+
+        Call this if the request failed for a reason that has nothing to do
+        with the host, so that another trial can be sent.
+
+        """
+        with self._lock:
+            if self._trial == threading.current_thread().ident:
+                self._trial = None
+
+    def record_success(self):
+        """ Record a successful request """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = None
+
+    def record_failure(self):
+        """ Record a failed request """
+        with self._lock:
+            self.failures += 1
+            self._trial = None
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
@@ -0,0 +1,13 @@
+""" Tests for steward """
+
+
+class FakeTime(object):
+
+    """ Replacement for the time module with a clock that tests control """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        """ Get the current fake time """
+        return self.now
@@ -0,0 +1,157 @@
+""" Tests for steward.auth """
+import hashlib
+import hmac
+import random
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import (Allow, Deny, Everyone, Authenticated,
+                              ALL_PERMISSIONS)
+from unittest import TestCase
+
+from steward.auth import CachedAuthDB, CompiledACLAuthorizationPolicy, IAuthDB
+
+
+PRINCIPALS = [Everyone, Authenticated, 'admin', 'dev', 'ops', 'alice', 'bob']
+PERMISSIONS = ['default', 'read', 'write', 'deploy']
+
+
+class Context(object):
+
+    """ Context with an ACL and no parent """
+    __name__ = __parent__ = None
+
+    def __init__(self, acl):
+        self.__acl__ = acl
+
+
+def random_acl(rand):
+    """ Build a random ACL with runs of Allow and Deny entries """
+    acl = []
+    for _ in xrange(rand.randint(0, 8)):
+        choice = rand.random()
+        if choice < 0.15:
+            permissions = ALL_PERMISSIONS
+        elif choice < 0.5:
+            permissions = rand.sample(PERMISSIONS, rand.randint(1, 3))
+        else:
+            permissions = rand.choice(PERMISSIONS)
+        acl.append((rand.choice([Allow, Deny]), rand.choice(PRINCIPALS),
+                    permissions))
+    return acl
+
+
+class TestCompiledACL(TestCase):
+
+    """ Tests for the compiled ACL authorization policy """
+
+    def setUp(self):
+        super(TestCompiledACL, self).setUp()
+        self.stock = ACLAuthorizationPolicy()
+
+    def assert_same(self, policy, context, principals, permission):
+        """ Check that a decision matches the stock policy """
+        expected = self.stock.permits(context, principals, permission)
+        result = policy.permits(context, principals, permission)
+        msg = "%r %r %r" % (context.__acl__, principals, permission)
+        self.assertEqual(bool(result), bool(expected), msg)
+        self.assertEqual(result.ace, expected.ace, msg)
+
+    def test_matches_stock_policy(self):
+        """ Decisions match the stock policy for random ACLs """
+        rand = random.Random(0)
+        for _ in xrange(300):
+            context = Context(random_acl(rand))
+            policy = CompiledACLAuthorizationPolicy(context.__acl__)
+            for _ in xrange(30):
+                principals = [Everyone] + rand.sample(PRINCIPALS,
+                                                      rand.randint(0, 4))
+                self.assert_same(policy, context, principals,
+                                 rand.choice(PERMISSIONS))
+
+    def test_first_match_wins(self):
+        """ An earlier Deny overrides a later Allow """
+        context = Context([
+            (Deny, 'bob', 'write'),
+            (Allow, 'dev', 'write'),
+        ])
+        policy = CompiledACLAuthorizationPolicy(context.__acl__)
+        self.assertFalse(policy.permits(context, ['bob', 'dev'], 'write'))
+        self.assertTrue(policy.permits(context, ['alice', 'dev'], 'write'))
+
+    def test_acl_grows(self):
+        """ Entries added to the ACL after compiling are honored """
+        context = Context([(Deny, Everyone, ALL_PERMISSIONS)])
+        policy = CompiledACLAuthorizationPolicy(context.__acl__)
+        self.assertFalse(policy.permits(context, ['dev'], 'read'))
+        context.__acl__.insert(0, (Allow, 'dev', 'read'))
+        self.assertTrue(policy.permits(context, ['dev'], 'read'))
+
+    def test_other_context(self):
+        """ Contexts with a different ACL use the stock policy """
+        policy = CompiledACLAuthorizationPolicy([])
+        context = Context([(Allow, 'dev', 'read')])
+        self.assertTrue(policy.permits(context, ['dev'], 'read'))
+
+
+class FakeAuthDB(IAuthDB):
+
+    """ Auth db with one user that counts password checks """
+
+    def __init__(self):
+        super(FakeAuthDB, self).__init__(None)
+        self.checks = 0
+
+    def authenticate(self, request, userid, password):
+        self.checks += 1
+        return userid == 'alice' and password == 'secret'
+
+    def groups(self, userid, request):
+        return ['dev']
+
+    def reload(self):
+        """ A method that only this auth db has """
+        return 'reloaded'
+
+
+class TestCachedAuthDB(TestCase):
+
+    """ Tests for the login cache """
+
+    def setUp(self):
+        super(TestCachedAuthDB, self).setUp()
+        self.auth_db = FakeAuthDB()
+        self.cached = CachedAuthDB(None, self.auth_db)
+
+    def test_cache_success(self):
+        """ Successful logins are cached """
+        self.assertTrue(self.cached.authenticate(None, 'alice', 'secret'))
+        self.assertTrue(self.cached.authenticate(None, 'alice', 'secret'))
+        self.assertEqual(self.auth_db.checks, 1)
+
+    def test_no_cache_failure(self):
+        """ Failed logins are not cached """
+        self.assertFalse(self.cached.authenticate(None, 'alice', 'wrong'))
+        self.assertFalse(self.cached.authenticate(None, 'alice', 'wrong'))
+        self.assertEqual(self.auth_db.checks, 2)
+        self.assertEqual(len(self.cached.cache), 0)
+
+    def test_generation_clears_cache(self):
+        """ Changing the generation of the auth db clears the cache """
+        self.cached.authenticate(None, 'alice', 'secret')
+        self.auth_db.generation += 1
+        self.assertTrue(self.cached.authenticate(None, 'alice', 'secret'))
+        self.assertEqual(self.auth_db.checks, 2)
+        self.assertEqual(len(self.cached.cache), 1)
+
+    def test_key_is_hmac(self):
+        """ The cache key is an HMAC of the credentials """
+        self.cached.authenticate(None, 'alice', 'secret')
+        key = list(self.cached.cache._data)[0]
+        expected = hmac.new(self.cached._key, 'alice\0secret',
+                            hashlib.sha256).digest()
+        self.assertEqual(key, expected)
+        self.assertNotIn('secret', key)
+
+    def test_delegate(self):
+        """ Other attributes come from the wrapped auth db """
+        self.assertEqual(self.cached.reload(), 'reloaded')
+        self.assertEqual(self.cached.groups('alice', None), ['dev'])
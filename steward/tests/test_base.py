@@ -0,0 +1,26 @@
+""" Tests for steward.base """
+from pyramid.config import Configurator
+from pyramid.request import Request
+from unittest import TestCase
+
+
+class TestVersion(TestCase):
+
+    """ Tests for the /version endpoint """
+
+    def test_no_includes(self):
+        """ The app starts without a pyramid.includes setting """
+        config = Configurator(settings={})
+        config.include('steward')
+        app = config.make_wsgi_app()
+        response = Request.blank('/version').get_response(app)
+        self.assertEqual(response.json, {})
+
+    def test_not_modified(self):
+        """ A request with a matching ETag gets a 304 """
+        config = Configurator(settings={})
+        config.include('steward')
+        app = config.make_wsgi_app()
+        etag = Request.blank('/version').get_response(app).etag
+        request = Request.blank('/version', if_none_match=etag)
+        self.assertEqual(request.get_response(app).status_int, 304)
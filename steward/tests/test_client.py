@@ -0,0 +1,90 @@
+""" Tests for steward.client """
+import requests
+from StringIO import StringIO
+from unittest import TestCase
+
+from steward.client import StewardClient, StewardREPL
+
+
+class TestREPL(TestCase):
+
+    """ Tests for the interactive client """
+
+    def run_repl(self, *lines):
+        """ Run the command loop on some lines and return the output """
+        stdin = StringIO('\n'.join(lines + ('exit', '')))
+        stdout = StringIO()
+        repl = StewardREPL(stdin=stdin, stdout=stdout)
+        repl.use_rawinput = False
+        repl.cmdloop()
+        return stdout.getvalue()
+
+    def test_cmdloop(self):
+        """ The command loop runs until exit """
+        self.run_repl()
+
+    def test_help(self):
+        """ help lists the commands """
+        self.assertIn('exit', self.run_repl('help'))
+
+    def test_help_command(self):
+        """ help <command> prints the help for a command """
+        self.assertIn('Run several commands in a single request',
+                      self.run_repl('help batch'))
+
+
+class FakeResponse(object):
+
+    """ Stand-in for a requests response """
+    status_code = 200
+
+    def close(self):
+        """ Nothing to release """
+        pass
+
+
+class TestHedging(TestCase):
+
+    """ Tests for sending commands to a backup host """
+
+    def setUp(self):
+        super(TestHedging, self).setUp()
+        self.client = StewardClient()
+        self.client.configure({
+            'host': ['http://primary', 'http://backup'],
+            'cookie_file': None,
+            'hedge_after': 0.01,
+            'idempotent_commands': ['/x'],
+        })
+        self.sent = []
+
+    def post(self, errors):
+        """ Replace _checked_post with one that fails on some hosts """
+        def checked_post(host, uri, data, request_kwargs):
+            """ Record the host and fail if it is in errors """
+            self.sent.append(host)
+            if host in errors:
+                raise errors[host]
+            return FakeResponse()
+        self.client._checked_post = checked_post
+
+    def test_no_hedge(self):
+        """ Commands for a specific host are never sent to another host """
+        self.post({'http://primary': requests.ConnectionError()})
+        with self.assertRaises(requests.ConnectionError):
+            self.client._send('http://primary', '/x', {}, {})
+        self.assertEqual(self.sent, ['http://primary'])
+
+    def test_hedge(self):
+        """ Hedged commands are answered by the backup if the host fails """
+        self.post({'http://primary': requests.ConnectionError()})
+        host, _ = self.client._send('http://primary', '/x', {}, {},
+                                    hedge=True)
+        self.assertEqual(host, 'http://backup')
+
+    def test_hedge_error(self):
+        """ Unexpected errors are raised instead of blocking forever """
+        self.post({'http://primary': ValueError(),
+                   'http://backup': ValueError()})
+        with self.assertRaises(ValueError):
+            self.client._send('http://primary', '/x', {}, {}, hedge=True)
@@ -0,0 +1,39 @@
+""" Tests for steward.profile """
+from unittest import TestCase
+
+from steward import profile
+from steward.profile import SlowRequests
+from steward.tests import FakeTime
+
+
+class TestSlowRequests(TestCase):
+
+    """ Tests for the slowest request tracker """
+
+    def setUp(self):
+        super(TestSlowRequests, self).setUp()
+        self.clock = FakeTime()
+        self._time = profile.time
+        profile.time = self.clock
+
+    def tearDown(self):
+        super(TestSlowRequests, self).tearDown()
+        profile.time = self._time
+
+    def test_keep_slowest(self):
+        """ Only the slowest requests are kept, slowest first """
+        slow = SlowRequests(size=2, window=60)
+        for duration in (1, 5, 3, 2):
+            slow.add(duration, {'path': str(duration)})
+        self.assertEqual([e['path'] for e in slow.slowest()], ['5', '3'])
+
+    def test_stale_entries_make_room(self):
+        """ Entries older than the window don't take up slots """
+        slow = SlowRequests(size=2, window=60)
+        slow.add(10, {'path': 'old1'})
+        slow.add(9, {'path': 'old2'})
+        self.clock.now += 61
+        slow.add(1, {'path': 'new1'})
+        slow.add(2, {'path': 'new2'})
+        self.assertEqual([e['path'] for e in slow.slowest()],
+                         ['new2', 'new1'])
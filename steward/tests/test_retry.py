@@ -0,0 +1,107 @@
+""" Tests for steward.retry """
+import threading
+from unittest import TestCase
+
+from steward import retry
+from steward.retry import CircuitBreaker, RetryPolicy
+from steward.tests import FakeTime
+
+
+class TestCircuitBreaker(TestCase):
+
+    """ Tests for the circuit breaker """
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.clock = FakeTime()
+        self._time = retry.time
+        retry.time = self.clock
+        self.breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+
+    def tearDown(self):
+        super(TestCircuitBreaker, self).tearDown()
+        retry.time = self._time
+
+    def open_circuit(self):
+        """ Record enough failures to open the circuit """
+        for _ in xrange(self.breaker.threshold):
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        """ The circuit opens after enough consecutive failures """
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        """ A success resets the count of consecutive failures """
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_single_trial(self):
+        """ After the timeout, only one trial request is let through """
+        self.open_circuit()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_success_closes(self):
+        """ A successful trial closes the circuit """
+        self.open_circuit()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_reopens(self):
+        """ A failed trial opens the circuit again """
+        self.open_circuit()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+
+    def test_cancel_trial(self):
+        """ A cancelled trial lets another trial through """
+        self.open_circuit()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.cancel_trial()
+        self.assertTrue(self.breaker.allow())
+
+    def test_cancel_other_thread_trial(self):
+        """ A thread can't cancel a trial that another thread is running """
+        self.open_circuit()
+        self.clock.now += 30
+        self.breaker.allow()
+        thread = threading.Thread(target=self.breaker.cancel_trial)
+        thread.start()
+        thread.join()
+        self.assertFalse(self.breaker.allow())
+
+
+class TestRetryPolicy(TestCase):
+
+    """ Tests for the retry policy """
+
+    def test_is_idempotent(self):
+        """ Commands are idempotent if they match a pattern """
+        policy = RetryPolicy(idempotent=['/pkg/*', '/version'])
+        self.assertTrue(policy.is_idempotent('/pkg/list'))
+        self.assertTrue(policy.is_idempotent('/version'))
+        self.assertFalse(policy.is_idempotent('/deploy'))
+
+    def test_delay_capped(self):
+        """ The backoff delay never exceeds the maximum """
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+        for attempt in xrange(1, 10):
+            delay = policy.delay(attempt)
+            self.assertTrue(0 <= delay <= min(3, 2 ** (attempt - 1)))
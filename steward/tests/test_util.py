@@ -0,0 +1,85 @@
+""" Tests for steward.util """
+from unittest import TestCase
+
+from steward import util
+from steward.tests import FakeTime
+from steward.util import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    """ Tests for the LRU cache """
+
+    def setUp(self):
+        super(TestLRUCache, self).setUp()
+        self.clock = FakeTime()
+        self._time = util.time
+        util.time = self.clock
+
+    def tearDown(self):
+        super(TestLRUCache, self).tearDown()
+        util.time = self._time
+
+    def test_get_set(self):
+        """ Values that were set can be retrieved """
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        """ Entries expire after the ttl """
+        cache = LRUCache(10, ttl=5)
+        cache.set('a', 1)
+        self.clock.now += 4
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.now += 2
+        self.assertIsNone(cache.get('a'))
+
+    def test_ttl_override(self):
+        """ The ttl can be set per entry """
+        cache = LRUCache(10, ttl=5)
+        cache.set('a', 1, ttl=60)
+        self.clock.now += 30
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_evict_least_recently_used(self):
+        """ When full, the least recently used entry is evicted """
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_delete_clear(self):
+        """ Entries can be removed """
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertNotIn('a', cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestPercentile(TestCase):
+
+    """ Tests for the nearest-rank percentile """
+
+    def test_nearest_rank(self):
+        """ The percentile is the smallest value with that rank or more """
+        values = range(1, 12)
+        self.assertEqual(util.percentile(values, 95), 11)
+        self.assertEqual(util.percentile(values, 50), 6)
+        self.assertEqual(util.percentile(values, 0), 1)
+        self.assertEqual(util.percentile(values, 100), 11)
+
+    def test_empty(self):
+        """ There is no percentile of an empty list """
+        self.assertIsNone(util.percentile([], 50))
@@ -0,0 +1,65 @@
+""" Tests for steward.views """
+import json
+from pyramid.config import Configurator
+from pyramid.request import Request
+from unittest import TestCase
+
+
+def do_echo(request):
+    """ Return the 'value' parameter """
+    return request.param('value')
+
+
+def do_boom(request):
+    """ Raise a KeyError """
+    raise KeyError('boom')
+
+
+class TestBatch(TestCase):
+
+    """ Tests for the /batch endpoint """
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        config = Configurator(settings={'pyramid.includes': 'steward'})
+        config.add_route('echo', '/test/echo')
+        config.add_view('steward.tests.test_views.do_echo',
+                        route_name='echo', renderer='json')
+        config.add_route('boom', '/test/boom')
+        config.add_view('steward.tests.test_views.do_boom',
+                        route_name='boom', renderer='json')
+        self.app = config.make_wsgi_app()
+
+    def batch(self, *commands):
+        """ Run a batch of commands and return the results """
+        request = Request.blank('/batch', POST={
+            'commands': json.dumps([{'route': route, 'params': params} for
+                                    route, params in commands])})
+        return request.get_response(self.app).json
+
+    def test_route_name(self):
+        """ Commands can use a route name """
+        result = self.batch(('echo', {'value': 'a'}))[0]
+        self.assertEqual(result, {'status': 200, 'result': 'a'})
+
+    def test_route_path(self):
+        """ Commands can use the path of a route """
+        result = self.batch(('/test/echo', {'value': 'a'}))[0]
+        self.assertEqual(result, {'status': 200, 'result': 'a'})
+
+    def test_unknown_route(self):
+        """ Unknown routes are a 404 """
+        results = self.batch(('missing', {}), ('/missing', {}))
+        self.assertEqual([r['status'] for r in results], [404, 404])
+
+    def test_view_error(self):
+        """ A KeyError raised by a view is a 500, not an unknown route """
+        result = self.batch(('boom', {}))[0]
+        self.assertEqual(result['status'], 500)
+
+    def test_order(self):
+        """ Results are returned in the order of the commands """
+        results = self.batch(('echo', {'value': 'a'}), ('boom', {}),
+                             ('echo', {'value': 'b'}))
+        self.assertEqual([r['status'] for r in results], [200, 500, 200])
+        self.assertEqual(results[2]['result'], 'b')
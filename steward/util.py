@@ -2,10 +2,20 @@
 import os
 
 import contextlib
+import datetime
+import math
+import re
 import shutil
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock
 from uuid import uuid1
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
 @contextlib.contextmanager
 def atomic_open(name, *args, **kwargs):
     """ Atomically open a file for reading/writing """
@@ -19,3 +29,175 @@ def atomic_open(name, *args, **kwargs):
     with open(tmpfile, *args, **kwargs) as ofile:
         yield ofile
     os.rename(tmpfile, name)
+
+
+def to_timestamp(dt):
+    """
+    Convert a datetime to a unix timestamp
+
+    Naive datetimes are assumed to be in UTC, which matches how
+    ``request.param`` parses datetime arguments.
+
+    """
+    offset = dt.utcoffset()
+    if offset is not None:
+        dt = dt.replace(tzinfo=None) - offset
+    return (dt - EPOCH).total_seconds()
+
+
+def percentile(values, pct):
+    """ Get a percentile of a sorted list using the nearest-rank method """
+    if not values:
+        return None
+    index = max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def _normalize_dist(name):
+    """ Normalize a distribution name the way metadata directories do """
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def _read_pkg_info_version(path):
+    """ Read the Version field from a PKG-INFO or METADATA file """
+    with open(path, 'r') as infile:
+        for line in infile:
+            if line.startswith('Version:'):
+                return line.split(':', 1)[1].strip()
+            if not line.strip():
+                break
+
+
+def distribution_version(name):
+    """
+    Get the version of an installed distribution
+
+    This looks for the distribution's metadata directly on ``sys.path``,
+    which is much faster than importing ``pkg_resources`` and building the
+    whole working set.
+
+    Parameters
+    ----------
+    name : str
+        The name of the distribution
+
+    Returns
+    -------
+    version : str or None
+        None if the distribution could not be found
+
+    """
+    target = _normalize_dist(name)
+    for path in sys.path:
+        path = path or '.'
+        # Zipped eggs are put on the path directly
+        if path.endswith('.egg'):
+            dist, _, version = os.path.basename(path)[:-4].partition('-')
+            if _normalize_dist(dist) == target and version:
+                return version.split('-')[0]
+        if not os.path.isdir(path):
+            continue
+        for entry in os.listdir(path):
+            base, ext = os.path.splitext(entry)
+            if ext not in ('.dist-info', '.egg-info'):
+                continue
+            dist, _, version = base.partition('-')
+            if _normalize_dist(dist) != target:
+                continue
+            if version:
+                return version.split('-')[0]
+            # Development installs don't put the version in the name
+            for filename in ('PKG-INFO', 'METADATA'):
+                metadata = os.path.join(path, entry, filename)
+                if os.path.isfile(metadata):
+                    return _read_pkg_info_version(metadata)
+    return None
+
+
+class LRUCache(object):
+
+    """
+    Thread-safe, size-bounded LRU cache with optional expiration
+
+    Parameters
+    ----------
+    max_size : int, optional
+        The maximum number of entries (default 1000)
+    ttl : float, optional
+        Number of seconds before an entry expires (default never)
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups that found a live entry
+    misses : int
+        Number of lookups that found nothing (or an expired entry)
+
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """ Get a value from the cache and mark it as recently used """
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (entry[1] is not None and entry[1] < now):
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key, value, ttl=None):
+        """
+        Put a value into the cache
+
+        Parameters
+        ----------
+        key : object
+        value : object
+        ttl : float, optional
+            Override the default ttl for this entry
+
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expire = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """ Remove a value from the cache """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Remove all values from the cache """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """ Get a dict of the cache size and hit/miss counts """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
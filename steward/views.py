@@ -1,20 +1,38 @@
 """ Steward's default endpoints """
 import logging
 import traceback
-from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPBadRequest, HTTPException
+from pyramid.interfaces import IRoutesMapper
 from pyramid.security import remember, authenticated_userid
 
+from steward.auth import asint
+
 
 LOG = logging.getLogger(__name__)
 
 
 def do_auth(request):
-    """ Authentication endpoint for clients to log in """
+    """
+    Authentication endpoint for clients to log in
+
+    Returns
+    -------
+    ticket : dict
+        The ``timeout`` and ``reissue_time`` of the auth ticket (in seconds),
+        so that clients can tell when they need to log in again, and the
+        ``cookie_name`` of the ticket so they can tell when it is reissued
+
+    """
     userid = request.param('userid')
     password = request.param('password')
     if request.registry.auth_db.authenticate(request, userid, password):
-        request.response.headers = remember(request, userid)
-        return request.response
+        request.response.headerlist.extend(remember(request, userid))
+        settings = request.registry.settings
+        return {
+            'timeout': asint(settings.get('steward.cookie.timeout')),
+            'reissue_time': asint(settings.get('steward.cookie.reissue_time')),
+            'cookie_name': settings.get('steward.cookie.name', 'auth_tkt'),
+        }
     raise HTTPBadRequest("Login failed")
 
 
@@ -23,6 +41,64 @@ def do_check_auth(request):
     return authenticated_userid(request)
 
 
+def _find_route(mapper, route):
+    """
+    Get the name of a route from its name or its path
+
+    Returns None if there is no such route.
+
+    """
+    if not route.startswith('/'):
+        return route if mapper.get_route(route) is not None else None
+    for candidate in mapper.get_routes():
+        if candidate.match(route) is not None:
+            return candidate.name
+    return None
+
+
+def do_batch(request):
+    """
+    Run many commands in a single request
+
+    Parameters
+    ----------
+    commands : list
+        Ordered list of ``{'route': <route>, 'params': <dict>}`` commands,
+        where ``route`` is either a route name or a path starting with '/'.
+        Each one is run as an internal subrequest.
+
+    Returns
+    -------
+    results : list
+        One entry per command, in order. Each is a dict with the ``status``
+        code and either the ``result`` or the error ``detail``.
+
+    """
+    commands = request.param('commands', type=list)
+    mapper = request.registry.getUtility(IRoutesMapper)
+    results = []
+    for command in commands:
+        if not isinstance(command, dict) or 'route' not in command:
+            raise HTTPBadRequest("Batch commands must be dicts with a 'route'")
+        route = command['route']
+        params = command.get('params') or {}
+        route_name = _find_route(mapper, route)
+        if route_name is None:
+            results.append({'status': 404,
+                            'detail': "Unknown route '%s'" % route})
+            continue
+        try:
+            result = request.subreq(route_name, **params)
+        except HTTPException as e:
+            results.append({'status': e.code, 'detail': e.detail})
+        except Exception as e:
+            LOG.exception("Error running batch command '%s'", route)
+            results.append({'status': 500, 'detail': str(e)})
+        else:
+            results.append({'status': 200, 'result': result})
+    return results
+
+
 def bad_request(context, request):
     """ Return 400's with a bit more context for the client """
     request.response.status_code = 400